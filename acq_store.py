@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+# Append-only, memory-mapped on-disk store for acquired data. Each shot is written into a preallocated file
+# alongside a compact index (shot number, parameters, timestamp, server status counts), so long runs don't
+# need to hold their data in RAM and a crash only loses the shot in progress. Readers get zero-copy views of
+# any range of shots, including while the scan is still running.
+#
+# A store called 'scan' consists of three files:
+#   scan.json - layout (samples per shot, maximum number of shots, parameter names, data type)
+#   scan.dat  - (max_shots, samples) data array
+#   scan.idx  - uint64 count of completed shots, followed by one index record per shot
+
+import json, time
+import numpy as np
+
+index_header_bytes = 8
+
+def _index_dtype(param_names):
+    return np.dtype([('shot', '<i8'),
+                     ('timestamp', '<f8'),
+                     ('length', '<u4'),
+                     ('infos', '<u2'),
+                     ('warnings', '<u2'),
+                     ('errors', '<u2')] + [('p_' + p, '<f8') for p in param_names])
+
+class AcqWriter:
+    """ Appends shots to a new on-disk store.
+
+    path: base path of the store, without extension
+    samples: maximum number of samples per shot
+    max_shots: number of shots to preallocate space for
+    param_names: names of the per-shot scalar parameters to record in the index (e.g. 'pe_idx', 'lo_freq')
+    flush_every: flush the memory maps to disk after this many shots (0 to leave it to the OS)
+    """
+
+    def __init__(self, path, samples, max_shots, param_names=(), dtype=np.complex64, flush_every=100):
+        self.path = path
+        self.samples = samples
+        self.max_shots = max_shots
+        self.param_names = tuple(param_names)
+        self.dtype = np.dtype(dtype)
+        self.flush_every = flush_every
+
+        with open(path + '.json', 'w') as f:
+            json.dump({'samples': samples, 'max_shots': max_shots,
+                       'param_names': self.param_names, 'dtype': self.dtype.str}, f)
+
+        self.data = np.memmap(path + '.dat', self.dtype, 'w+', shape=(max_shots, samples))
+        idx_dtype = _index_dtype(self.param_names)
+        with open(path + '.idx', 'wb') as f:
+            f.truncate(index_header_bytes + max_shots * idx_dtype.itemsize)
+        self._count = np.memmap(path + '.idx', '<u8', 'r+', shape=(1,))
+        self.index = np.memmap(path + '.idx', idx_dtype, 'r+', offset=index_header_bytes, shape=(max_shots,))
+        self.count = 0
+
+    def append(self, data, params=None, status=None, timestamp=None):
+        """ data: acquired samples for one shot (at most self.samples long)
+        params: dict of values for the parameter names given at construction; missing ones are stored as NaN
+        status: server_comms.Reply, or a server status dict (reply[5]), whose infos/warnings/errors are counted
+        timestamp: defaults to the current time
+
+        Returns the shot number.
+        """
+        k = self.count
+        assert k < self.max_shots, "Store is full ({:d} shots)".format(self.max_shots)
+        assert data.size <= self.samples, "Shot has {:d} samples, store holds {:d}".format(data.size, self.samples)
+
+        self.data[k, :data.size] = data
+        rec = self.index[k]
+        rec['shot'] = k
+        rec['timestamp'] = time.time() if timestamp is None else timestamp
+        rec['length'] = data.size
+        if status is not None:
+            for st in ('infos', 'warnings', 'errors'):
+                rec[st] = len(status.get(st, ()) if isinstance(status, dict) else getattr(status, st))
+        for p in self.param_names:
+            rec['p_' + p] = np.nan if params is None else params.get(p, np.nan)
+
+        # Publish the shot only once its data and index record are in place
+        self.count = k + 1
+        self._count[0] = self.count
+        if self.flush_every and self.count % self.flush_every == 0:
+            self.flush()
+        return k
+
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+        self._count.flush()
+
+    def close(self):
+        self.flush()
+        del self.data, self.index, self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class AcqReader:
+    """ Read-only access to a store, which may still be being written to by an AcqWriter.
+
+    All accessors return np.memmap views into the files, not copies.
+    """
+
+    def __init__(self, path):
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.samples = meta['samples']
+        self.max_shots = meta['max_shots']
+        self.param_names = tuple(meta['param_names'])
+
+        self.data = np.memmap(path + '.dat', np.dtype(meta['dtype']), 'r', shape=(self.max_shots, self.samples))
+        self._count = np.memmap(path + '.idx', '<u8', 'r', shape=(1,))
+        self.index = np.memmap(path + '.idx', _index_dtype(self.param_names), 'r',
+                               offset=index_header_bytes, shape=(self.max_shots,))
+
+    def __len__(self):
+        """ number of completed shots """
+        return int(self._count[0])
+
+    def shots(self, start=0, stop=None):
+        """ (shots, samples) view of the data for shots [start, stop); stop defaults to the last completed shot """
+        n = len(self)
+        stop = n if stop is None else min(stop, n)
+        return self.data[start:stop]
+
+    def shot(self, k):
+        """ data of a single shot, trimmed to its acquired length """
+        assert k < len(self), "Shot {:d} has not been acquired yet".format(k)
+        return self.data[k, :self.index[k]['length']]
+
+    def records(self, start=0, stop=None):
+        """ index records for shots [start, stop) """
+        n = len(self)
+        stop = n if stop is None else min(stop, n)
+        return self.index[start:stop]
+
+    def param(self, name, start=0, stop=None):
+        """ values of a recorded parameter for shots [start, stop) """
+        return self.records(start, stop)['p_' + name]
+
+def test_AcqStore():
+    import tempfile, os
+    samples = 2110
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'scan')
+        with AcqWriter(path, samples, 1000, param_names=('pe_idx',)) as w:
+            r = AcqReader(path)
+            for k in range(256):
+                data = (np.random.randn(samples) + 1j * np.random.randn(samples)).astype(np.complex64)
+                w.append(data, {'pe_idx': k - 128}, status={'infos': ['ok']}) # in a real scan, data = Experiment.run()
+                if k % 64 == 63:
+                    print("reader sees {:d} shots, mean |data| {:.3f}".format(len(r), np.abs(r.shots()).mean()))
+            print("phase encodes of last 4 shots: ", r.param('pe_idx', len(r) - 4))
+            assert len(r) == 256 and r.param('pe_idx', 252).tolist() == [124, 125, 126, 127]
+
+if __name__ == "__main__":
+    test_AcqStore()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+#
+# BRAM allocation planner for multi-run protocols. Given the TX or gradient segments each run of a protocol uses,
+# it decides where every segment lives in BRAM, which segments stay resident between runs, which are evicted, and
+# what has to be uploaded before each run, so that the bytes sent over a whole scan are minimised without ever
+# exceeding the board's capacity.
+#
+# The server writes raw_tx_data and grad_mem_* starting from address 0, so an upload always covers a prefix of the
+# BRAM: the cost of a run is the end address of the highest segment that has to be (re)loaded for it. The planner
+# therefore packs segments that are reused in later runs from the top of the BRAM downwards and single-use
+# segments from the bottom upwards, and when space runs out it evicts the resident segment whose next use is
+# furthest away. If that would cost more than repacking the run's segments from address 0, it repacks instead,
+# so a plan never uploads more than sending each run's segments afresh.
+
+import numpy as np
+
+import server_comms as sc
+
+class RunPlan:
+    """ BRAM plan for one run of a protocol.
+
+    offsets: {key: offset} for the segments this run uses, in samples; pass these to TXOFFSET/GRADOFFSET
+    resident: {key: offset} for every segment held in BRAM during this run (a superset of offsets)
+    loaded: keys that are (re)loaded before this run
+    evicted: keys that were dropped from BRAM to make room for this run
+    upload_size: number of samples to upload before this run (0 if nothing changed)
+    """
+
+    def __init__(self, offsets, resident, loaded, evicted, upload_size):
+        self.offsets = offsets
+        self.resident = resident
+        self.loaded = loaded
+        self.evicted = evicted
+        self.upload_size = upload_size
+
+def _gaps(resident, sizes, capacity):
+    """ free (start, stop) ranges between resident segments """
+    gaps = []
+    pos = 0
+    for off, key in sorted((off, key) for key, off in resident.items()):
+        if off > pos:
+            gaps.append((pos, off))
+        pos = max(pos, off + sizes[key])
+    if pos < capacity:
+        gaps.append((pos, capacity))
+    return gaps
+
+def _place(size, resident, sizes, capacity, top_down):
+    fits = [g for g in _gaps(resident, sizes, capacity) if g[1] - g[0] >= size]
+    if not fits:
+        return None
+    if top_down:
+        return max(fits, key=lambda g: g[1])[1] - size
+    return min(fits)[0]
+
+def _place_incremental(needed, resident, sizes, capacity, next_use):
+    """ Place the needed segments that aren't resident yet, evicting the resident segments used furthest in the
+    future as necessary; returns (resident, loaded, evicted), or (None, None, None) if fragmentation prevents it """
+    loaded, evicted = [], []
+    # Place the largest segments first, to limit fragmentation
+    for key in sorted((k for k in needed if k not in resident), key=lambda k: -sizes[k]):
+        reused = next_use(key) < np.inf
+        off = _place(sizes[key], resident, sizes, capacity, top_down=reused)
+        while off is None:
+            victims = [k for k in resident if k not in needed]
+            if not victims:
+                return None, None, None
+            victim = max(victims, key=next_use)
+            del resident[victim]
+            evicted.append(victim)
+            off = _place(sizes[key], resident, sizes, capacity, top_down=reused)
+        resident[key] = off
+        loaded.append(key)
+    return resident, loaded, evicted
+
+def plan(runs, sizes, capacity):
+    """ runs: list (one entry per run) of the segment keys each run uses
+    sizes: {key: segment length in samples}
+    capacity: BRAM size in samples (server_comms.tx_bram_samples or grad_bram_samples)
+
+    Returns a list of RunPlans, one per run.
+    """
+    # Runs in which each key is used, for looking up next uses
+    uses = {}
+    for r, keys in enumerate(runs):
+        for k in keys:
+            uses.setdefault(k, []).append(r)
+
+    def next_use(key, r):
+        u = uses[key]
+        i = np.searchsorted(u, r, side='right')
+        return u[i] if i < len(u) else np.inf
+
+    resident = {}
+    plans = []
+    for r, keys in enumerate(runs):
+        needed = list(dict.fromkeys(keys))
+        total = sum(sizes[k] for k in needed)
+        if total > capacity:
+            raise ValueError("Run {:d} needs {:d} samples of BRAM, capacity is {:d}".format(r, total, capacity))
+
+        new_resident, loaded, evicted = _place_incremental(needed, dict(resident), sizes, capacity,
+                                                           lambda k: next_use(k, r))
+        upload_size = None if new_resident is None else max((new_resident[k] + sizes[k] for k in loaded), default=0)
+
+        if upload_size is None or upload_size > total:
+            # Cheaper (or only possible) to repack this run's segments from address 0: single-use ones first,
+            # so the reused ones end up together
+            evicted = [k for k in resident if k not in needed]
+            new_resident, pos = {}, 0
+            for k in sorted(needed, key=lambda k: next_use(k, r) < np.inf):
+                new_resident[k] = pos
+                pos += sizes[k]
+            loaded, upload_size = needed, total
+
+        resident = new_resident
+        plans.append(RunPlan({k: resident[k] for k in needed}, dict(resident), loaded, evicted, upload_size))
+
+        # Segments that are never used again don't need to stay resident
+        for k in needed:
+            if next_use(k, r) == np.inf:
+                del resident[k]
+
+    return plans
+
+def build_image(run_plan, segments):
+    """ BRAM image to upload before a run: run_plan.upload_size samples, with every resident segment inside that
+    range in its place (segments already resident are re-sent unchanged, since uploads always start at 0).
+
+    segments: {key: waveform}, time along the last axis (1D TX vectors, or (3, n) gradient arrays)
+    """
+    first = next(iter(segments.values()))
+    img = np.zeros(first.shape[:-1] + (run_plan.upload_size,), first.dtype)
+    for key, off in run_plan.resident.items():
+        seg = segments[key]
+        n = min(seg.shape[-1], run_plan.upload_size - off)
+        if n > 0:
+            img[..., off:off + n] = seg[..., :n]
+    return img
+
+def test_plan():
+    # A phase-encoded protocol: the excitation and readout pulses are used in every run, and each run
+    # also uses one of 64 different preparation pulses
+    rng = np.random.default_rng(0)
+    segments = {'exc': rng.standard_normal(2000), 'refoc': rng.standard_normal(3000)}
+    runs = []
+    for k in range(64):
+        segments['prep{:d}'.format(k)] = rng.standard_normal(1500)
+        runs.append(['exc', 'prep{:d}'.format(k), 'refoc'])
+    sizes = {k: v.size for k, v in segments.items()}
+
+    plans = plan(runs, sizes, sc.tx_bram_samples)
+    naive = sum(sum(sizes[k] for k in keys) for keys in runs)
+    planned = sum(p.upload_size for p in plans)
+    print("samples uploaded: {:d} naively, {:d} planned".format(naive, planned))
+    print("run 1 offsets: {}".format(plans[1].offsets))
+    img = build_image(plans[1], segments)
+    assert np.array_equal(img[plans[1].offsets['prep1']:][:1500], segments['prep1'])
+
+if __name__ == "__main__":
+    test_plan()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+#
+# Loop-aware compaction of TX and gradient waveforms. Segments passed to Experiment.add_tx()/add_grad() are
+# searched for periodic repetition and for duplicates of each other; only one copy of each distinct period is
+# stored in BRAM, and the sequencer replays it with a DEC/JNZ loop around a TXOFFSET/GRADOFFSET + PR pair.
+# replay_asm() generates the matching assembly for the ocra assembler, with PR delays in FPGA clock cycles.
+#
+# Note that the loop instructions themselves take a few clock cycles per repetition, so replayed waveforms
+# have small gaps between periods compared to a fully unrolled waveform. Periods are therefore kept at least
+# min_period samples long (a constant segment is stored as min_period samples or more, not as one sample
+# replayed once per sample), which bounds the number of gaps.
+
+import numpy as np
+
+import server_comms as sc
+
+def _divisors(n):
+    small = [d for d in range(1, int(n ** 0.5) + 1) if n % d == 0]
+    return sorted(set(small + [n // d for d in small]))
+
+# Waveforms in full-scale units match if they agree to within half a DAC LSB
+dac_atol = 0.5 / 32767
+
+def _key(block):
+    """ hashable key identifying a block by its DAC codes """
+    codes = np.rint(block * 32767) if block.dtype.kind in 'fc' else block
+    return block.shape, codes.tobytes()
+
+def find_period(x, min_repeats=2, atol=dac_atol, min_period=1):
+    """ Shortest period p >= min_period such that x (1D, or 2D with time along the last axis) is x[..., :p]
+    repeated n // p times (to within atol), with at least min_repeats repetitions; returns x.shape[-1] if there is
+    no such period """
+    n = x.shape[-1]
+    for p in _divisors(n):
+        if p < min_period:
+            continue
+        if n // p < min_repeats:
+            break
+        if np.allclose(x[..., p:], x[..., :-p], rtol=0, atol=atol):
+            return p
+    return n
+
+class Compaction:
+    """ Result of compact(): the BRAM image to upload, and where each segment lives in it.
+
+    data: compacted waveform data (time along the last axis)
+    offsets, periods, repeats: per-segment arrays; segment k is data[..., offsets[k]:offsets[k] + periods[k]]
+    played repeats[k] times
+    """
+
+    def __init__(self, data, offsets, periods, repeats, original_size):
+        self.data = data
+        self.offsets = offsets
+        self.periods = periods
+        self.repeats = repeats
+        self.original_size = original_size
+
+    @property
+    def size(self):
+        return self.data.shape[-1]
+
+    @property
+    def unrolled(self):
+        """ True if nothing was compacted, i.e. the layout is that of the segments concatenated """
+        return bool(np.all(self.repeats == 1)) and self.size == self.original_size
+
+    def expand(self, k):
+        """ segment k, unrolled """
+        o, p = self.offsets[k], self.periods[k]
+        return np.tile(self.data[..., o:o + p], self.repeats[k])
+
+def compact(segments, min_repeats=2, atol=dac_atol, min_period=64):
+    """ segments: list of waveforms (1D complex TX vectors, or (3, n) gradient arrays)
+
+    Each segment is reduced to its shortest period of at least min_period samples, and periods with identical DAC
+    codes (across all segments) are stored once.
+    """
+    blocks = {}
+    stored = []
+    offsets, periods, repeats = [], [], []
+    size = 0
+    for seg in segments:
+        p = find_period(seg, min_repeats, atol, min_period)
+        block = np.ascontiguousarray(seg[..., :p])
+        key = _key(block)
+        try:
+            off = blocks[key]
+        except KeyError:
+            off = blocks[key] = size
+            stored.append(block)
+            size += p
+        offsets.append(off)
+        periods.append(p)
+        repeats.append(seg.shape[-1] // p)
+
+    original_size = sum(s.shape[-1] for s in segments)
+    data = np.concatenate(stored, axis=-1) if stored else np.zeros(0)
+    return Compaction(data, np.array(offsets), np.array(periods), np.array(repeats), original_size)
+
+def replay_asm(comp, k, kind, cmd_reg, ctr_reg, ctr_var, sample_t, loop_addr,
+               clk_freq_MHz=sc.fpga_clock_freq_MHz):
+    """ Assembly that plays segment k of a Compaction.
+
+    kind: 'TX' or 'GRAD', selecting TXOFFSET or GRADOFFSET
+    cmd_reg: register holding the output word to issue while the waveform plays (e.g. TX_GATE | TX_PULSE)
+    ctr_reg: register used as the loop counter
+    ctr_var: name of the variable holding the repeat count
+    sample_t: waveform sample period in us (Experiment.tx_t for TX; 10 for the gradients)
+    loop_addr: address at which the first returned code line will be placed
+    clk_freq_MHz: FPGA clock frequency; PR delays are given in its cycles, rounded to the nearest cycle (exact for
+    Experiment.tx_t, which is a whole number of cycles)
+
+    Returns (var_lines, code_lines); var_lines have to go in the variable section at the top of the program
+    (ctr_var must be declared before its first use). Segments that don't repeat are played with a single PR.
+    """
+    offset_instr = {'TX': 'TXOFFSET', 'GRAD': 'GRADOFFSET'}[kind]
+    off, per, rep = int(comp.offsets[k]), int(comp.periods[k]), int(comp.repeats[k])
+    cycles = int(round(per * sample_t * clk_freq_MHz))
+
+    if rep == 1:
+        return [], ["{:s} {:d}".format(offset_instr, off),
+                    "PR {:d}, {:d}c".format(cmd_reg, cycles)]
+
+    var_lines = ["{:s} = {:#x}".format(ctr_var, rep)]
+    code_lines = ["LD64 {:d}, {:s}".format(ctr_reg, ctr_var),
+                  "{:s} {:d}".format(offset_instr, off), # loop_addr + 1: start of the loop
+                  "PR {:d}, {:d}c".format(cmd_reg, cycles),
+                  "DEC {:d}".format(ctr_reg),
+                  "JNZ {:d}, {:#x}".format(ctr_reg, loop_addr + 1)]
+    return var_lines, code_lines
+
+def test_compact():
+    tx_t = 12 / sc.fpga_clock_freq_MHz # Experiment().tx_t
+    t = np.arange(2048) * tx_t
+    burst = np.exp(2j * np.pi * t / (128 * tx_t)) # period of 128 samples
+    sinc = np.sinc((t - t[1024]) / 25)
+
+    comp = compact([burst, sinc, 0.5 * sinc, sinc])
+    print("TX samples: {:d} unrolled, {:d} compacted".format(comp.original_size, comp.size))
+    for k in range(4):
+        print("segment {:d}: offset {:d}, period {:d} samples x {:d}".format(
+            k, comp.offsets[k], comp.periods[k], comp.repeats[k]))
+        assert np.allclose(comp.expand(k), [burst, sinc, 0.5 * sinc, sinc][k], rtol=0, atol=dac_atol)
+
+    var_lines, code_lines = replay_asm(comp, 0, 'TX', cmd_reg=5, ctr_reg=2, ctr_var='BURST_CTR', sample_t=tx_t,
+                                       loop_addr=0x1d)
+    print("\n".join(var_lines + code_lines))
+
+if __name__ == "__main__":
+    test_compact()
@@ -1,21 +1,209 @@
 #!/usr/bin/env python3
+#
+# Local stand-in for the MaRCoS server, for testing the client without the hardware. It speaks the same msgpack
+# protocol and emulates the replies to a subset of the server's commands (see DummyServer.process_packet()):
+# settings are accepted, raw_tx_data and grad_mem_* are size-checked, acq returns a running sample counter (so
+# that stitched acquisitions can be checked) and test_throughput returns the same arrays as the real server. It
+# also decompresses fields compressed by server_comms.Compressor, if compression is enabled. Acquisitions can be
+# made to take real time (acq_rate), and an emergency stop from another connection aborts them.
+#
+# Run it from the command line to serve on localhost:11111, or start it from a test:
+#   srv = DummyServer().start()
+#   s.connect(('localhost', srv.port))
+# or in a child process with start_process().
 
-## THIS DOESN'T DO ANYTHING USEFUL YET
-
-import socket
+import collections, socketserver, threading, time
+import numpy as np
 import msgpack
 
-def sock_test():
+import server_comms as sc
+
+# Requests that are accepted without any checks
+_settings = ('lo_freq', 'tx_div', 'rf_amp', 'rx_rate', 'tx_size', 'tx_samples', 'recomp_pul', 'seq_data',
+             'grad_offs_x', 'grad_offs_y', 'grad_offs_z', 'fpga_clk')
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        srv = self.server
+        if srv.compression:
+            unpacker = msgpack.Unpacker(ext_hook=sc.decompress_ext, max_buffer_size=0)
+        else:
+            unpacker = msgpack.Unpacker(max_buffer_size=0)
+        while True:
+            buf = self.request.recv(65536)
+            if not buf:
+                return
+            with srv.lock:
+                srv.bytes_received += len(buf)
+            unpacker.feed(buf)
+            for packet in unpacker:
+                reply = srv.process_packet(packet)
+                self.request.sendall(msgpack.packb(reply))
+                if packet[0] == sc.close_server_pkt:
+                    threading.Thread(target=srv.shutdown, daemon=True).start()
+                    return
+
+class DummyServer(socketserver.ThreadingTCPServer):
+    """ Emulated MaRCoS server.
+
+    address: (host, port) to listen on; port 0 picks a free port (see self.port)
+    compression: whether to offer payload compression to clients
+    acq_rate: acquisition speed in samples per second (None: instantaneous)
+    history: number of requests kept in self.requests
+
+    self.requests holds the (decompressed) data of the latest requests received, and self.bytes_received the number
+    of bytes received over the socket. Acquired sample k (over all acq requests) has the value k + 0j.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('localhost', 0), compression=True, acq_rate=None, history=100):
+        super().__init__(address, _Handler)
+        self.compression = compression
+        self.acq_rate = acq_rate
+        self.stop_event = threading.Event() # replaced after every emergency stop
+        self.stops = 0
+        self.lock = threading.Lock()
+        self.bytes_received = 0
+        self.requests = collections.deque(maxlen=history)
+        self.acq_count = 0 # samples acquired so far
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """ serve from a background thread """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def process_packet(self, packet):
+        command, packet_idx, _, version, data = packet[:5]
+        status = {'errors': [], 'warnings': [], 'infos': []}
+        results = {}
+
+        if command == sc.close_server_pkt:
+            status['infos'].append('Shutting down server.')
+        elif command == sc.emergency_stop_pkt:
+            with self.lock:
+                self.stop_event.set()
+                self.stop_event = threading.Event()
+                self.stops += 1
+            status['infos'].append('Emergency stop: sequence and acquisition halted.')
+        else:
+            self._check_version(version, status)
+            if isinstance(data, dict) and data:
+                with self.lock:
+                    self.requests.append(data)
+                self._run_requests(data, results, status)
+            else:
+                status['errors'].append('no commands present or incorrectly formatted request')
+
+        return [sc.reply_pkt, 1, 0, sc.version_full, results, {k: v for k, v in status.items() if v}]
+
+    def _check_version(self, version, status):
+        v = (version >> 16, (version >> 8) & 0xff, version & 0xff)
+        if v == (sc.version_major, sc.version_minor, sc.version_debug):
+            return
+        msg = 'Client version {:d}.{:d}.{:d} {{:s}} server version {:d}.{:d}.{:d}'.format(
+            *v, sc.version_major, sc.version_minor, sc.version_debug)
+        if v[0] != sc.version_major:
+            status['errors'].append(msg.format('significantly different from'))
+        elif v[1] != sc.version_minor:
+            status['warnings'].append(msg.format('different from'))
+        else:
+            status['infos'].append(msg.format('differs slightly from'))
+
+    def _run_requests(self, data, results, status):
+        unknown = 0
+        for key, val in data.items():
+            if key in _settings:
+                results[key] = 0
+            elif key == 'compression' and self.compression:
+                results[key] = [m for m in sc.compression_methods if m in val]
+            elif key == 'raw_tx_data':
+                n = len(val)
+                if n > 4 * sc.tx_bram_samples:
+                    results[key] = -1
+                    status['errors'].append('too much raw TX data')
+                else:
+                    results[key] = 0
+                    status['infos'].append('tx data bytes copied: {:d}'.format(n))
+            elif key in ('grad_mem_x', 'grad_mem_y', 'grad_mem_z'):
+                c, n, limit = key[-1], len(val), 4 * sc.grad_bram_samples
+                if n > limit:
+                    results[key] = -1
+                    status['errors'].append('too much grad mem {:s} data: {:d} bytes > {:d}'.format(c, n, limit))
+                else:
+                    results[key] = 0
+                    status['infos'].append('gradient mem {:s} data bytes copied: {:d}'.format(c, n))
+            elif key == 'acq':
+                if val > sc.acq_max_samples:
+                    results[key] = -1
+                    status['errors'].append('acq of {:d} samples exceeds the RX FIFO ({:d})'.format(
+                        val, sc.acq_max_samples))
+                    continue
+                n = val
+                if self.acq_rate:
+                    with self.lock:
+                        stop = self.stop_event
+                    t = time.monotonic()
+                    if stop.wait(val / self.acq_rate):
+                        n = min(val, int((time.monotonic() - t) * self.acq_rate))
+                        status['errors'].append('acquisition aborted by emergency stop after {:d} samples'.format(n))
+                with self.lock:
+                    start, self.acq_count = self.acq_count, self.acq_count + n
+                results[key] = np.arange(start, start + n).astype(np.complex64).tobytes()
+            elif key == 'test_throughput':
+                k = np.arange(val)
+                results[key] = {'array1': (1.01 * k).tolist(), 'array2': (1.01 * (k + 10)).tolist()}
+            else:
+                unknown += 1
+                results['UNKNOWN{:d}'.format(unknown)] = -1
+        if unknown:
+            status['errors'].append('not all client commands were understood')
+
+def _serve(pipe, kwargs):
+    srv = DummyServer(**kwargs)
+    pipe.send(srv.port)
+    srv.serve_forever()
+
+def start_process(**kwargs):
+    """ Run a DummyServer (with the given keyword arguments) in a child process, so that its threads, sockets and
+    memory don't show up in measurements of the client. Returns (process, port); stop it with process.terminate().
+    """
+    import multiprocessing as mp
+    ctx = mp.get_context('spawn')
+    parent, child = ctx.Pipe()
+    proc = ctx.Process(target=_serve, args=(child, kwargs), daemon=True)
+    proc.start()
+    port = parent.recv()
+    return proc, port
+
+def test_dummy_server():
+    import socket
+    srv = DummyServer().start()
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        # s.connect( ("localhost", 11111) )
-        s.bind( ("localhost", 11111) )
-        s.listen()
-        # msg = msgpack.packb({'sdf':3, 'asdf':4})
-        conn, addr = s.accept()
-        with conn:
-            print("Connected by ", addr)
-            data = conn.recv(1024)
-            print(data)
+        s.connect(('localhost', srv.port))
+        comp = sc.Compressor()
+        print("negotiated compression:", sc.negotiate_compression(s, comp))
+        grad = bytearray(4 * sc.grad_bram_samples)
+        grad[:400] = b'\x01\x02\x03\x04' * 100
+        n0 = srv.bytes_received
+        reply = sc.send_packet(sc.construct_packet({'grad_mem_x': grad, 'raw_tx_data': b"0123456789abcdef" * 4096},
+                                                   compressor=comp), s)
+        sc.process(reply, print_all=True)
+        print("sent {:d} bytes of payload in {:d} bytes; stats {}".format(
+            comp.bytes_in, srv.bytes_received - n0, comp.stats))
+    srv.stop()
 
 if __name__ == "__main__":
-    sock_test()
+    srv = DummyServer(('localhost', 11111))
+    print("Dummy MaRCoS server listening on port {:d}".format(srv.port))
+    srv.serve_forever()
@@ -1,27 +1,55 @@
 #!/usr/bin/env python3
 # 
 # Basic toolbox for server operations; wraps up a lot of stuff to avoid the need for hardcoding on the user's side.
+#
+# Only NumPy and the socket are needed to run an Experiment; plotting and debugging modules are imported
+# inside the example functions that use them, to keep startup fast for scripts and worker processes.
 
 import socket, time, warnings
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.fft as fft
-import scipy.signal as sig
-
-import pdb
-st = pdb.set_trace
 
 from local_config import ip_address, port, fpga_clk_freq_MHz
-from ocra_lib.assembler import Assembler
+from ocra_lib.assembler import assemble_batch
 import server_comms as sc
+import sequence_sim
+import compaction
+
+dac_full_scale = 32767
+
+def quantize(x, axis=None):
+    """ Full-scale float data (-1 to 1) to int16 DAC codes, rounded and saturated in float32.
+    Returns (codes, saturated): the number of values that were clipped, in total or along the given axis. """
+    buf = np.multiply(x, dac_full_scale, dtype=np.float32)
+    np.rint(buf, out=buf)
+    over = (buf > 32767) | (buf < -32768)
+    saturated = np.count_nonzero(over, axis=axis)
+    np.clip(buf, -32768, 32767, out=buf)
+    return buf.astype(np.int16), saturated
 
 class Experiment:
     """ Wrapper class for managing an entire experimental sequence 
-    samples: number of (I,Q) samples to acquire during a shot of the experiment
+    samples: number of (I,Q) samples to acquire during a shot of the experiment; if None, the instruction stream is
+    simulated (see sequence_sim.py) on every compile, and self.samples is set to the number of samples its RX
+    windows produce (self.auto_samples is then True)
     lo_freq: local oscillator frequency, MHz
     tx_t: RF TX sampling time in microseconds; will be rounded to a multiple of system clocks (for the STEMlab-122, it's 122.88 MHz). For example if tx_t = 1000, then a new RF TX sample will be output approximately every microsecond.
     (self.tx_t will have the true value after construction.)
     rx_t: RF RX sampling time in microseconds; as above (approximately). If samples = 100 and rx_t = 1.5, then samples will be taken for 150 us total.    
+    instruction_file: assembly program for the sequencer; or a function of (tx_compaction, grad_compaction)
+    returning the program as text or a list of lines, which is called during compilation
+    compact: store only one copy of repeated or duplicated TX/gradient segments in BRAM (see compaction.py). The
+    tables self.tx_compaction/self.grad_compaction give each segment's offset, period and repeat count after
+    compilation, and compaction.replay_asm() generates the loops to play them. A hand-written instruction_file
+    addresses the unrolled layout, so if anything was compacted the program has to come from a function (see
+    above); compilation raises a ValueError otherwise.
+    grad_conditioner: optional grad_conditioning.GradConditioner, applied to all gradient segments in one batch
+    during compilation (resampling, eddy-current pre-emphasis, per-axis gain/offset correction and clipping)
+    reporter: optional server_comms.Reporter, to print the status of each reply; nothing is printed otherwise.
+    compressor: optional server_comms.Compressor for the TX, gradient and instruction uploads of each run. It's
+    negotiated with the server on its first run (see server_comms.negotiate_compression()), so one compressor can
+    be shared by many Experiments without repeating that round trip.
+    After each run, self.reply holds the parsed server_comms.Reply, and self.reply_stats counts status messages
+    and failures over all runs.
     """
 
     def __init__(self,
@@ -29,8 +57,19 @@ class Experiment:
                  lo_freq=5,
                  tx_t=0.1,
                  rx_t=0.5,
-                 instruction_file="ocra_lib/grad_echo.txt"):
+                 instruction_file="ocra_lib/grad_echo.txt",
+                 compact=False,
+                 grad_conditioner=None,
+                 reporter=None,
+                 compressor=None):
         self.samples = samples
+        self.auto_samples = samples is None
+        self.reporter = reporter
+        self.compressor = compressor
+        self.reply = None
+        self.reply_stats = sc.ReplyStats()
+        self.compact = compact
+        self.grad_conditioner = grad_conditioner
 
         self.lo_freq_bin = int(np.round(lo_freq / fpga_clk_freq_MHz * (1 << 30))) & 0xfffffff0 | 0xf
         self.lo_freq = self.lo_freq_bin * fpga_clk_freq_MHz / (1 << 30)
@@ -42,136 +81,214 @@ class Experiment:
         self.tx_t = self.tx_div / fpga_clk_freq_MHz
 
         self.instruction_file = instruction_file
-        self.asmb = Assembler()
 
         # Segments for RF TX and gradient BRAMs
         self.tx_offsets = []
         self.current_tx_offset = 0
+        self.tx_segments = [] # complex64 vectors or (n, 2) int16 codes, as passed to add_tx()
 
         self.grad_offsets = []
         self.current_grad_offset = 0
+        self.grad_segments = [] # (3, n) float32 or int16 arrays, as passed to add_grad()
+        self.grad_segment_dts = [] # their sample periods (None: already at the gradient update period)
 
     def add_tx(self, vec):
-        """ vec: complex vector in the I,Q range [-1,1] and [-j,j]; units of full-scale RF DAC output.
+        """ vec: complex vector in the I,Q range [-1,1] and [-j,j]; units of full-scale RF DAC output. It's stored as
+        complex64, so passing complex64 avoids a conversion.
         (Note that the magnitude of each element must be <= 1, i.e. np.abs(1+1j) is sqrt(2) and thus too high.)
+        Alternatively, vec can be pre-quantized DAC codes: an int16 array of shape (n, 2) holding I, Q pairs, which
+        is sent as it is.
         
         Returns the index of the relevant vector, which can be used later when the pulse sequence is being compiled.
-        """                
+        """
+        if vec.dtype == np.int16:
+            assert vec.ndim == 2 and vec.shape[1] == 2, "Supply int16 TX codes as an (n, 2) array of I, Q pairs."
+            seg = vec
+        else:
+            seg = np.ascontiguousarray(vec, np.complex64)
+
         self.tx_offsets.append(self.current_tx_offset)
-        self.current_tx_offset += vec.size
-        try:
-            self.tx_data = np.hstack( [self.tx_data, vec] )
-        except AttributeError:
-            self.tx_data = vec
+        self.current_tx_offset += seg.shape[0]
+        self.tx_segments.append(seg)
 
         return len(self.tx_offsets) - 1
 
-    def add_grad(self, vec_x, vec_y, vec_z):
-        """ vec_x/y/z: real vector in the range [-1,1] units of full-scale gradient DAC output.
+    def add_grad(self, vec_x, vec_y, vec_z, dt=None):
+        """ vec_x/y/z: real vector in the range [-1,1] units of full-scale gradient DAC output; stored as float32.
+        Alternatively, all three can be pre-quantized int16 DAC codes, which are sent as they are (unless a
+        grad_conditioner has to process them).
+        dt: sample period of the vectors in us, if they weren't authored at the gradient update period
+        (server_comms.grad_t); they'll be resampled during compilation by the grad_conditioner (a default one is
+        created if necessary).
         
         Returns the index of the relevant vector, which can be used later when the pulse sequence is being compiled.
         """
         assert vec_x.size == vec_y.size == vec_z.size, "Supply equal-length vectors for the three gradients."
-        self.grad_offsets.append(self.current_grad_offset)
-        self.current_grad_offset += vec_x.size
-
-        try:
-            self.grad_data_x = np.hstack( [self.grad_data_x, vec_x] )
-        except AttributeError:
-            self.grad_data_x = vec_x
+        codes = [v.dtype == np.int16 for v in (vec_x, vec_y, vec_z)]
+        assert all(codes) or not any(codes), "Supply either int16 codes or full-scale values for all three gradients."
+        if dt is not None and self.grad_conditioner is None:
+            from grad_conditioning import GradConditioner # deferred: pulls in scipy.signal
+            self.grad_conditioner = GradConditioner()
 
-        try:
-            self.grad_data_y = np.hstack( [self.grad_data_y, vec_y] )
-        except AttributeError:            
-            self.grad_data_y = vec_y
+        n = vec_x.size if self.grad_conditioner is None else self.grad_conditioner.output_length(vec_x.size, dt)
+        self.grad_offsets.append(self.current_grad_offset)
+        self.current_grad_offset += n
 
-        try:            
-            self.grad_data_z = np.hstack( [self.grad_data_z, vec_z] )
-        except AttributeError:            
-            self.grad_data_z = vec_z
+        # Segments are only concatenated at compile time, rather than copying everything on each call
+        seg = np.empty((3, vec_x.size), np.int16 if all(codes) else np.float32)
+        seg[0], seg[1], seg[2] = vec_x, vec_y, vec_z
+        self.grad_segments.append(seg)
+        self.grad_segment_dts.append(dt)
 
         return len(self.grad_offsets) - 1
 
     def compile_tx_data(self):
         """ go through the TX data and prepare binary array to send to the server """
-        self.tx_bytes = bytearray(self.tx_data.size * 4)
-        if np.any(np.abs(self.tx_data) > 1.0):
-            warnings.warn("TX data too large! Overflow will occur.")
-        
-        tx_i = np.round(32767 * self.tx_data.real).astype(np.uint16)
-        tx_q = np.round(32767 * self.tx_data.imag).astype(np.uint16)
-
-        # TODO: find a better way to encode the interleaved bytearray
-        self.tx_bytes[::4] = (tx_i & 0xff).astype(np.uint8).tobytes()
-        self.tx_bytes[1::4] = (tx_i >> 8).astype(np.uint8).tobytes()
-        self.tx_bytes[2::4] = (tx_q & 0xff).astype(np.uint8).tobytes()
-        self.tx_bytes[3::4] = (tx_q >> 8).astype(np.uint8).tobytes()
+        codes = []
+        self.tx_saturated = 0
+        self.tx_over_magnitude = 0 # samples with |I + jQ| > 1, even if neither I nor Q clips
+        for seg in self.tx_segments:
+            if seg.dtype == np.int16:
+                codes.append(seg)
+            else:
+                c, sat = quantize(seg.view(np.float32).reshape(-1, 2)) # (n, 2) I, Q pairs
+                codes.append(c)
+                self.tx_saturated += sat
+                self.tx_over_magnitude += np.count_nonzero(np.abs(seg) > 1)
+        if self.tx_saturated or self.tx_over_magnitude:
+            warnings.warn("TX data too large! {:d} samples have a magnitude above 1; {:d} I/Q values saturated at "
+                          "full scale.".format(self.tx_over_magnitude, self.tx_saturated))
+        self.tx_codes = np.concatenate(codes) if codes else np.zeros((0, 2), np.int16)
+
+        if self.compact:
+            self.tx_compaction = compaction.compact([c.T for c in codes])
+            tx_codes = self.tx_compaction.data.T
+        else:
+            tx_codes = self.tx_codes
+
+        if tx_codes.shape[0] > sc.tx_bram_samples:
+            warnings.warn("TX data ({:d} samples) exceeds the TX BRAM ({:d} samples)!".format(tx_codes.shape[0], sc.tx_bram_samples))
+
+        # Little-endian I, Q pairs are exactly the layout the server expects
+        self.tx_bytes = bytearray(np.ascontiguousarray(tx_codes, '<i2').tobytes())
 
     def compile_grad_data(self):
         """ go through the grad data and prepare binary array to send to the server """
-        self.grad_x_bytes = bytearray(self.grad_data_x.size * 4)
-        self.grad_y_bytes = bytearray(self.grad_data_y.size * 4)
-        self.grad_z_bytes = bytearray(self.grad_data_z.size * 4)
-        for gd in [self.grad_data_x, self.grad_data_y, self.grad_data_z]:
-            if np.any(np.abs(gd) > 1.0):
-                warnings.warn("Grad data too large! Overflow will occur.")
-        
-        grx = np.round(32767 * self.grad_data_x).astype(np.uint16)
-        gry = np.round(32767 * self.grad_data_y).astype(np.uint16)
-        grz = np.round(32767 * self.grad_data_z).astype(np.uint16)        
-        
-        # TODO: check that this makes sense relative to test_acquire,
-        # and find a better way to encode the interleaved bytearray
-        self.grad_x_bytes[::4] = ((grx & 0xf) << 4).astype(np.uint8).tobytes()
-        self.grad_x_bytes[1::4] = ((grx & 0xff0) >> 4).astype(np.uint8).tobytes()
-        self.grad_x_bytes[2::4] = ((grx >> 12) | 0x10).astype(np.uint8).tobytes()
-        self.grad_x_bytes[3::4] = np.zeros(self.grad_data_x.size, dtype=np.uint8).tobytes() # wasted?
-
-        self.grad_y_bytes[::4] = ((gry & 0xf) << 4).astype(np.uint8).tobytes()
-        self.grad_y_bytes[1::4] = ((gry & 0xff0) >> 4).astype(np.uint8).tobytes()
-        self.grad_y_bytes[2::4] = ((gry >> 12) | 0x10).astype(np.uint8).tobytes()
-        self.grad_y_bytes[3::4] = np.zeros(self.grad_data_y.size, dtype=np.uint8).tobytes() # wasted?
-        
-        self.grad_z_bytes[::4] = ((grz & 0xf) << 4).astype(np.uint8).tobytes()
-        self.grad_z_bytes[1::4] = ((grz & 0xff0) >> 4).astype(np.uint8).tobytes()
-        self.grad_z_bytes[2::4] = ((grz >> 12) | 0x10).astype(np.uint8).tobytes()
-        self.grad_z_bytes[3::4] = np.zeros(self.grad_data_z.size, dtype=np.uint8).tobytes() # wasted?
+        if self.grad_conditioner is not None:
+            segments = self.grad_conditioner.condition(
+                [s / np.float32(dac_full_scale) if s.dtype == np.int16 else s for s in self.grad_segments],
+                self.grad_segment_dts)
+            if np.any(self.grad_conditioner.clipped):
+                warnings.warn("Grad data clipped by the conditioner on some axes! Samples clipped (x, y, z): {}".format(
+                    self.grad_conditioner.clipped.tolist()))
+        else:
+            segments = self.grad_segments
+
+        codes = []
+        self.grad_saturated = np.zeros(3, int)
+        for seg in segments:
+            if seg.dtype == np.int16:
+                codes.append(seg)
+            else:
+                c, sat = quantize(seg, axis=1)
+                codes.append(c)
+                self.grad_saturated += sat
+        if np.any(self.grad_saturated):
+            warnings.warn("Grad data too large! Values saturated at full scale (x, y, z): {}".format(
+                self.grad_saturated.tolist()))
+        self.grad_codes = np.concatenate(codes, axis=1) if codes else np.zeros((3, 0), np.int16)
+
+        if self.compact:
+            # All three channels share GRADOFFSET, so they're compacted together
+            self.grad_compaction = compaction.compact(codes)
+            grad_codes = self.grad_compaction.data
+        else:
+            grad_codes = self.grad_codes
+
+        if grad_codes.shape[1] > sc.grad_bram_samples:
+            warnings.warn("Grad data ({:d} samples) exceeds the gradient BRAM ({:d} samples)!".format(grad_codes.shape[1], sc.grad_bram_samples))
+
+        # Each 32-bit word holds the 16-bit code in bits 4-19, with bit 20 set
+        # TODO: check that this makes sense relative to test_acquire
+        words = (grad_codes.view(np.uint16).astype(np.uint32) << 4) | 0x00100000
+        self.grad_x_bytes, self.grad_y_bytes, self.grad_z_bytes = (bytearray(w.astype('<u4').tobytes()) for w in words)
 
     def compile_instructions(self):
         # For now quite simple (using the ocra assembler)
         # Will use a more advanced approach in the future to avoid having to hand-code the instruction files
-        self.instructions = self.asmb.assemble(self.instruction_file)        
+        # The batch assembler is stateless and doesn't write a hex file on every compile
+        if self.compact and not hasattr(self, 'tx_compaction'):
+            self.compile_tx_data()
+            self.compile_grad_data()
+        if callable(self.instruction_file):
+            if self.compact:
+                source = self.instruction_file(self.tx_compaction, self.grad_compaction)
+            else:
+                source = self.instruction_file(None, None)
+        else:
+            if self.compact and not (self.tx_compaction.unrolled and self.grad_compaction.unrolled):
+                raise ValueError("The TX/grad data were compacted, but {:s} addresses the unrolled layout; pass a "
+                                 "function generating the program from the compactions as instruction_file "
+                                 "(see compaction.replay_asm())".format(self.instruction_file))
+            with open(self.instruction_file) as f:
+                source = f.read()
+        table, lengths, _ = assemble_batch([source])
+        self.instructions = table[0, :lengths[0]].tobytes()
 
     def compile(self):
         self.compile_tx_data()
         self.compile_grad_data()
         self.compile_instructions()
+        if self.auto_samples: # the segments or the program may have changed since the last compile
+            self.samples = self.simulate().rx_samples(self.rx_t)
 
-    def run(self):
+    def simulate(self):
+        """ Simulate the compiled instruction stream offline; returns a sequence_sim.Timeline with the gate and offset
+        timelines, total duration and number of RX samples, without needing the hardware """
+        try:
+            instructions = self.instructions
+        except AttributeError:
+            self.compile_instructions()
+            instructions = self.instructions
+        return sequence_sim.simulate(instructions, fpga_clk_freq_MHz)
+
+    def run(self, conn=None):
         """ compile the TX and grad data, send everything over.
+        conn: (host, port) of the server, connected to for this run only (default: local_config's), or an open
+        server_comms Connection (possibly recording) or ReplayConnection
         Returns the resultant data """
         self.compile()
-        packet = sc.construct_packet({
+        data = {
             'lo_freq': self.lo_freq_bin,
             'rx_rate': self.rx_div,
             'tx_div': self.tx_div,
-            'tx_size': self.tx_data.size * 4,
+            'tx_size': len(self.tx_bytes),
             'raw_tx_data': self.tx_bytes,
             'grad_mem_x': self.grad_x_bytes,
             'grad_mem_y': self.grad_y_bytes,
             'grad_mem_z': self.grad_z_bytes,            
             'seq_data': self.instructions,
-            'acq': self.samples})
+            'acq': self.samples}
 
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect( (ip_address, port) )
-        
-        reply = sc.send_packet(packet, s)
+        if conn is None or isinstance(conn, tuple):
+            with socket.create_connection(conn or (ip_address, port)) as s:
+                reply = self._send(data, s)
+        else:
+            reply = self._send(data, conn)
+
+        self.reply = sc.parse_reply(reply, self.reply_stats, self.reporter)
+        acq = self.reply.results.get('acq')
+        if not isinstance(acq, bytes):
+            raise RuntimeError("acquisition failed: {}".format(list(self.reply.errors)))
+        return np.frombuffer(acq, np.complex64)
 
-        # Better handling of reply packet; i.e. print infos, warnings and errors
-        return np.frombuffer(reply[4]['acq'], np.complex64)
+    def _send(self, data, conn):
+        if self.compressor is not None and not self.compressor.negotiated:
+            sc.negotiate_compression(conn, self.compressor)
+        return sc.send_packet(sc.construct_packet(data, compressor=self.compressor), conn)
 
 def test_Experiment():
+    import matplotlib.pyplot as plt
     exp = Experiment(samples=500)
     
     # first TX segment
@@ -194,6 +311,7 @@ def test_Experiment():
     plt.show()
 
 def test_grad_echo():
+    import matplotlib.pyplot as plt
     exp = Experiment(samples=1900 + 210, lo_freq=0.5) # sampling rate is off by 2x?
     
     # RF pulse
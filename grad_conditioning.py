@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+#
+# Gradient conditioning for Experiment.add_grad()/compile_grad_data(). All segments on all three axes are
+# processed together in a few NumPy/SciPy calls:
+#   - resampling to the gradient update period (linear interpolation), so waveforms can be authored at any rate
+#   - eddy-current pre-emphasis: each axis gets x + sum_i a_i * highpass(x, tau_i), a sum of first-order
+#     exponential terms
+#   - per-axis gain and offset correction
+#   - clipping to the DAC full scale, with a per-axis count of clipped samples
+# Each segment is filtered from a zero initial state, since the time between segments depends on the sequence.
+
+from functools import lru_cache
+import numpy as np
+import scipy.signal as sig
+
+import server_comms as sc
+
+@lru_cache(maxsize=64)
+def preemph_filter(terms, dt):
+    """ (b, a) IIR coefficients of the pre-emphasis filter
+
+    terms: tuple of (amplitude, time constant in us) pairs
+    dt: sample period, us
+    """
+    b, a = np.array([1.0]), np.array([1.0])
+    for amp, tau in terms:
+        # Add amp * alpha (1 - z^-1) / (1 - alpha z^-1) to b/a
+        alpha = np.exp(-dt / tau)
+        den = np.array([1.0, -alpha])
+        b = np.polyadd(np.polymul(b, den), amp * alpha * np.polymul(a, [1.0, -1.0]))
+        a = np.polymul(a, den)
+    return b, a
+
+class GradConditioner:
+    """ Batched gradient conditioning stage.
+
+    gain, offset: per-axis (x, y, z) correction, applied as gain * g + offset in full-scale units
+    preemph: eddy-current compensation terms, either one list of (amplitude, tau_us) pairs for all axes or a
+    list of three such lists, one per axis
+    dt: output sample period, us (the gradient update period)
+
+    After condition(), self.clipped holds the number of samples clipped on each axis.
+    """
+
+    def __init__(self, gain=(1, 1, 1), offset=(0, 0, 0), preemph=(), dt=sc.grad_t):
+        self.gain = np.asarray(gain, float).reshape(3, 1, 1)
+        self.offset = np.asarray(offset, float).reshape(3, 1, 1)
+        if len(preemph) == 3 and all(isinstance(p, (list, tuple)) and
+                                     all(isinstance(t, (list, tuple)) for t in p) for p in preemph):
+            per_axis = preemph
+        else:
+            per_axis = [preemph] * 3
+        self.preemph = tuple(tuple((float(a), float(tau)) for a, tau in p) for p in per_axis)
+        self.dt = dt
+        self.clipped = np.zeros(3, int)
+
+    def output_length(self, n, dt=None):
+        """ number of output samples for an n-sample segment with sample period dt (None: already at self.dt) """
+        return n if dt is None else int(round(n * dt / self.dt))
+
+    def _resample(self, segments, dts):
+        """ linear interpolation of all segments in one gather over their concatenation """
+        lengths = [s.shape[1] for s in segments]
+        starts = np.cumsum([0] + lengths[:-1])
+        pos = np.concatenate([
+            st + (np.arange(n) if dt is None else np.minimum(np.arange(self.output_length(n, dt)) * self.dt / dt, n - 1))
+            for st, n, dt in zip(starts, lengths, dts)])
+        ends = np.repeat(starts + np.array(lengths) - 1, [self.output_length(n, dt) for n, dt in zip(lengths, dts)])
+        i0 = np.floor(pos).astype(int)
+        i1 = np.minimum(i0 + 1, ends)
+        frac = pos - i0
+        data = np.concatenate(segments, axis=1)
+        return data[:, i0] * (1 - frac) + data[:, i1] * frac
+
+    def condition(self, segments, dts=None):
+        """ segments: list of (3, n) arrays (x, y, z), full-scale units
+        dts: per-segment sample periods in us (None entries, or dts=None, for segments already at self.dt)
+
+        Returns the list of conditioned (3, n_out) float32 segments.
+        """
+        if not segments:
+            self.clipped = np.zeros(3, int)
+            return []
+        if dts is None:
+            dts = [None] * len(segments)
+        out_lengths = [self.output_length(s.shape[1], dt) for s, dt in zip(segments, dts)]
+        if any(dt is not None for dt in dts):
+            flat = self._resample(segments, dts)
+        else:
+            flat = np.concatenate(segments, axis=1)
+
+        # Pad into a (3, segments, longest) block so every segment is filtered in the same call; the filter is
+        # causal, so trailing padding doesn't affect the samples that are kept
+        longest = max(out_lengths)
+        block = np.zeros((3, len(segments), longest))
+        mask = np.arange(longest) < np.array(out_lengths)[:, None]
+        block[:, mask] = flat
+
+        if any(self.preemph):
+            if self.preemph[0] == self.preemph[1] == self.preemph[2]:
+                block = sig.lfilter(*preemph_filter(self.preemph[0], self.dt), block, axis=-1)
+            else:
+                for ax in range(3):
+                    if self.preemph[ax]:
+                        block[ax] = sig.lfilter(*preemph_filter(self.preemph[ax], self.dt), block[ax], axis=-1)
+
+        block = block * self.gain + self.offset
+        over = (np.abs(block) > 1) & mask
+        self.clipped = over.sum(axis=(1, 2))
+        np.clip(block, -1, 1, out=block)
+
+        block = block.astype(np.float32)
+        return [block[:, k, :n] for k, n in enumerate(out_lengths)]
+
+def test_GradConditioner():
+    import time
+    # EPI-style readout train: 64 alternating trapezoids authored at 2 us, plus blips
+    t_ramp = np.linspace(0, 1, 20)
+    lobe = np.hstack([t_ramp, np.ones(200), t_ramp[::-1]]) * 0.8
+    segments, dts = [], []
+    for k in range(64):
+        segments.append(np.vstack([lobe * (-1) ** k, np.zeros_like(lobe), np.zeros_like(lobe)]))
+        dts.append(2)
+    gc = GradConditioner(gain=(0.9, 1, 1), offset=(0.01, 0, 0), preemph=[(0.02, 500), (0.005, 50)])
+
+    t0 = time.perf_counter()
+    out = gc.condition(segments, dts)
+    print("conditioned {:d} segments in {:.2f} ms; {:d} -> {:d} samples each; clipped per axis: {}".format(
+        len(out), (time.perf_counter() - t0) * 1e3, segments[0].shape[1], out[0].shape[1], gc.clipped))
+
+if __name__ == "__main__":
+    test_GradConditioner()
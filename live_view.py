@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#
+# Non-blocking live display of acquired data. Plotting runs in its own process, fed through a small shared-
+# memory ring (see shm_ring.py); the acquisition loop only copies each shot into the ring and never waits on
+# the GUI. The viewer redraws at a fixed frame rate using only the newest shot, so stale frames are dropped
+# rather than queued up.
+
+import time, warnings
+import multiprocessing as mp
+import numpy as np
+
+from shm_ring import ShotRing, ShotRingReader
+
+def latest_shot(reader, shown=-1):
+    """ Newest shot in a ShotRingReader's ring published after shot number shown that can still be read intact.
+    Returns (seq, data, skipped), data being a copy and skipped the number of shots after shown that won't be
+    displayed; or None if there's no such shot. A shot that's being overwritten is passed over for the one before. """
+    seq = reader.head - 1
+    while seq > shown:
+        data = reader.read(seq, copy=True)
+        if data is not None:
+            return seq, data, seq - shown - 1
+        seq -= 1
+    return None
+
+def _viewer_main(ring_name, fps, title, stop):
+    import matplotlib.pyplot as plt # only the viewer process pays for the GUI imports
+
+    with ShotRingReader(ring_name) as r:
+        plt.ion()
+        fig, axs = plt.subplots(2, 1)
+        fig.canvas.manager.set_window_title(title)
+        line_re, = axs[0].plot([], [], label='real')
+        line_im, = axs[0].plot([], [], label='imag')
+        line_abs, = axs[1].plot([], [], label='abs')
+        for ax in axs:
+            ax.grid(True)
+            ax.legend(loc='upper right')
+        text = axs[0].set_title('')
+
+        shown = -1
+        dropped = 0
+        frame_t = 1 / fps
+        while not stop.is_set() and plt.fignum_exists(fig.number):
+            t0 = time.monotonic()
+            latest = latest_shot(r, shown)
+            if latest is not None:
+                seq, data, skipped = latest
+                dropped += skipped
+                x = np.arange(data.size)
+                line_re.set_data(x, data.real)
+                line_im.set_data(x, data.imag)
+                line_abs.set_data(x, np.abs(data))
+                text.set_text('shot {:d} ({:d} dropped)'.format(seq, dropped))
+                for ax in axs:
+                    ax.relim()
+                    ax.autoscale_view()
+                fig.canvas.draw_idle()
+                shown = seq
+            fig.canvas.flush_events()
+            time.sleep(max(0, frame_t - (time.monotonic() - t0)))
+        plt.close(fig)
+
+class LiveViewer:
+    """ Live plot of the most recent shot, drawn by a separate process.
+
+    samples: maximum number of samples per shot
+    fps: maximum redraw rate of the viewer
+
+    Call update() with each shot's data from the acquisition loop; it returns as soon as the data has been copied
+    into shared memory. If the viewer process has died (e.g. matplotlib isn't available, or there's no display),
+    update() warns once and carries on.
+    """
+
+    def __init__(self, samples, fps=10, title="MaRCoS live view"):
+        # A few slots are enough, since the viewer only ever shows the latest shot
+        self.ring = ShotRing(slots=4, slot_samples=samples)
+        self._stop = mp.Event()
+        self.proc = mp.Process(target=_viewer_main, args=(self.ring.name, fps, title, self._stop), daemon=True)
+        self.proc.start()
+        self._warned = False
+
+    def update(self, data):
+        self.ring.publish(data)
+        if not self._warned and not self.proc.is_alive():
+            self._warned = True
+            warnings.warn("live viewer process exited with code {}; nothing is being displayed".format(
+                self.proc.exitcode))
+
+    def close(self, timeout=2):
+        self._stop.set()
+        self.proc.join(timeout)
+        if self.proc.is_alive():
+            self.proc.terminate()
+        self.ring.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def test_LiveViewer():
+    # Simulated acquisition loop running much faster than the display
+    samples = 2110
+    t = np.arange(samples)
+    with LiveViewer(samples) as lv:
+        t0 = time.monotonic()
+        for k in range(2000):
+            data = (np.exp(-((t - samples / 2) / 300) ** 2) * np.exp(2j * np.pi * (k % 100) / 1000 * t)).astype(np.complex64)
+            lv.update(data) # data = Experiment.run() in a real scan
+            time.sleep(2e-3)
+        print("{:.1f} shots/s with the viewer running".format(2000 / (time.monotonic() - t0)))
+
+if __name__ == "__main__":
+    test_LiveViewer()
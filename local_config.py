@@ -0,0 +1,3 @@
+ip_address = "localhost"
+port = 11111
+fpga_clk_freq_MHz = 122.88
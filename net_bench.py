@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#
+# Network characterisation of the client-server link. Sweeps payload sizes for uploads (raw_tx_data, grad_mem_*)
+# and downloads (acq, test_throughput) against a server or the dummy server, and reports round-trip latency
+# percentiles and throughput for each size. A linear fit of time against message size gives the per-message
+# overhead and the asymptotic throughput of each field, from which chunk sizes for the client are recommended:
+# the smallest chunk whose overhead is at most a given fraction of its transfer time, and the number of
+# pipelined requests (server_comms.acquire(depth=...)) needed to hide the round-trip latency.
+#
+# Example: python net_bench.py --server 192.168.1.163:11111 --repeats 50
+
+import argparse, math, sys, time
+import numpy as np
+import msgpack
+
+import server_comms as sc
+
+def _pow2_sizes(lo, hi):
+    return [1 << k for k in range(int(math.log2(lo)), int(math.log2(hi)) + 1)]
+
+# field: (direction, request value for a size, largest size); sizes are in bytes for uploads, and in
+# samples or array elements for downloads
+fields = {
+    'raw_tx_data': ('up', lambda n: bytes(n), 4 * sc.tx_bram_samples),
+    'grad_mem_x': ('up', lambda n: bytes(n), 4 * sc.grad_bram_samples),
+    'grad_mem_y': ('up', lambda n: bytes(n), 4 * sc.grad_bram_samples),
+    'grad_mem_z': ('up', lambda n: bytes(n), 4 * sc.grad_bram_samples),
+    'acq': ('down', lambda n: n, sc.acq_max_samples),
+    'test_throughput': ('down', lambda n: n, 1 << 20),
+}
+
+def measure(conn, field, sizes, repeats=20):
+    """ Round-trip times of requests of each size for one field.
+
+    Returns a list of dicts, one per size: size, bytes (request plus reply, as sent over the link), times (s).
+    """
+    make = fields[field][1]
+    results = []
+    for n in sizes:
+        packet = sc.construct_packet({field: make(n)})
+        reply = conn.transact(packet) # warm-up, and the reply size
+        nbytes = len(msgpack.packb(packet)) + len(msgpack.packb(reply))
+        times = np.empty(repeats)
+        for k in range(repeats):
+            t = time.perf_counter()
+            conn.transact(packet)
+            times[k] = time.perf_counter() - t
+        results.append({'size': n, 'bytes': nbytes, 'times': times})
+    return results
+
+def fit(results):
+    """ (per-message overhead in s, throughput in MB/s) from a least-squares fit of the median round-trip time
+    against the number of bytes transferred. Residuals are weighted by 1/time (i.e. relative errors), so that
+    the large messages don't swamp the overhead estimate from the small ones. """
+    nbytes = np.array([r['bytes'] for r in results], float)
+    t = np.array([np.median(r['times']) for r in results])
+    slope, overhead = np.polyfit(nbytes, t, 1, w=1 / t)
+    return max(overhead, 0.0), (1 / slope / 1e6 if slope > 0 else np.inf)
+
+def recommend(results, field, max_overhead=0.1):
+    """ Recommended request size for a field: the smallest power of two whose fitted per-message overhead is at
+    most max_overhead of its round-trip time, capped at the field's limit. Returns (size, depth), depth being the
+    number of requests to keep in flight so the link stays busy. """
+    limit = fields[field][2]
+    overhead, MBps = fit(results)
+    # bytes per unit of size, from the largest measurement
+    r = results[-1]
+    bytes_per_unit = r['bytes'] / r['size']
+    need = overhead * (1 - max_overhead) / max_overhead * MBps * 1e6 / bytes_per_unit
+    size = min(1 << max(int(math.ceil(math.log2(max(need, 1)))), 0), limit)
+    transfer = size * bytes_per_unit / (MBps * 1e6)
+    depth = 1 + int(math.ceil(overhead / transfer)) if transfer > 0 else 1
+    return size, depth
+
+def report(field, results, log=print):
+    overhead, MBps = fit(results)
+    size, depth = recommend(results, field)
+    log("{:s} ({:s}load)".format(field, fields[field][0]))
+    log("  {:>9s} {:>10s} {:>9s} {:>9s} {:>9s} {:>9s}".format('size', 'bytes', 'p50 ms', 'p95 ms', 'p99 ms', 'MB/s'))
+    for r in results:
+        p50, p95, p99 = np.percentile(r['times'], [50, 95, 99])
+        log("  {:9d} {:10d} {:9.3f} {:9.3f} {:9.3f} {:9.1f}".format(
+            r['size'], r['bytes'], p50 * 1e3, p95 * 1e3, p99 * 1e3, r['bytes'] / p50 / 1e6))
+    msg = "  fit: {:.3f} ms per message + {:.1f} MB/s; recommended chunk {:d}".format(overhead * 1e3, MBps, size)
+    if fields[field][0] == 'down':
+        msg += ", {:d} in flight".format(depth) # uploads aren't pipelined
+    log(msg)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Characterise the throughput and latency of the server link")
+    parser.add_argument('--server', default=None, metavar='HOST:PORT',
+                        help="server to measure (default: a local dummy server)")
+    parser.add_argument('--fields', nargs='+', default=list(fields), choices=list(fields))
+    parser.add_argument('--repeats', type=int, default=20, help="round trips per size")
+    parser.add_argument('--min-size', type=int, default=64)
+    args = parser.parse_args(argv)
+
+    srv = None
+    if args.server is None:
+        import dummy_server
+        srv, port = dummy_server.start_process()
+        address = ('localhost', port)
+    else:
+        host, port = args.server.rsplit(':', 1)
+        address = (host, int(port))
+    try:
+        with sc.Connection(address, timeout=30) as conn:
+            for field in args.fields:
+                results = measure(conn, field, _pow2_sizes(args.min_size, fields[field][2]), args.repeats)
+                report(field, results)
+    finally:
+        if srv is not None:
+            srv.terminate()
+            srv.join()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,16 +7,23 @@ Generates machine code from code written in the assembly language.
 Outputs two files, out_bin.txt, which contains the commands in binary, 
 and out_hex.txt, which contains the commands in hex.
 See sample usage at the bottom (commented out).
+assemble_batch() assembles many programs (or variants of a template) at once into a NumPy table, without
+writing any files.
 Comments must be prefaced by //
 Variables must come first
 Numerical values of variables must be in base 16 (hexadecimal)
+PR delays are in us, or in clock cycles with a c suffix (e.g. PR 3, 1536c)
 Author: Suma Anand
 """
-import pdb # Debugging
 import numpy as np
 import math
 import logging # For errors
 import struct
+from functools import lru_cache
+
+# Module logger; nothing is configured on import or construction, so the caller decides where (and whether)
+# the assembler log goes. See the sample usage at the bottom.
+logger = logging.getLogger(__name__)
 
 printing = False
 def print_dbg(*args, **kwargs):
@@ -54,8 +61,7 @@ class Assembler:
 		self.var_table = {}
 
 		# Logging
-		self.logger = logging.getLogger()
-		logging.basicConfig(filename = 'assembler.log', filemode = 'w', level = logging.DEBUG)
+		self.logger = logger
 
 	
 	def var_parser(self,line):
@@ -86,7 +92,7 @@ class Assembler:
 				cmd_byte = self.bit_table.get(word)
 				# If not in the dictionary, it is an invalid command
 				if not cmd_byte:    
-					logging.error("Unknown command {}".format(word), stack_info=True)
+					logger.error("Unknown command %s", word, stack_info=True)
 					raise ValueError("Unknown command {}".format(word))
 				cmd_bit = int(cmd_byte, 16) # Convert to bits
 				cmds_bit.append(cmd_bit)
@@ -107,7 +113,7 @@ class Assembler:
 
 		# Error checking
 		if opcode not in self.opcode_table.keys():				  
-			logging.error("Unknown opcode {}".format(opcode), stack_info=True)
+			logger.error("Unknown opcode %s", opcode, stack_info=True)
 			raise ValueError("Unknown opcode {} on line {}".format(opcode, line))
 
 		opcode_bin = self.opcode_table[opcode][0] # Convert to binary from the dict
@@ -152,8 +158,11 @@ class Assembler:
 		# Format B
 		elif self.opcode_table[opcode][1] == 'B':
 			if opcode == 'PR': # PR
-				conversion_factor = 1/(7e-3) # us to ns, assuming 7ns clock cycle
-				num_cycles = math.floor(int(line[2]) * conversion_factor) # Round down
+				if line[2].endswith('c'): # delay given in clock cycles
+					num_cycles = int(line[2][:-1])
+				else:
+					conversion_factor = 1/(7e-3) # us to ns, assuming 7ns clock cycle
+					num_cycles = math.floor(int(line[2]) * conversion_factor) # Round down
 				const = format(num_cycles, 'b').zfill(40)
 				reg_addr = format(int(line[1]), 'b')
 				print_dbg(reg_addr)
@@ -195,7 +204,7 @@ class Assembler:
 			if line[:2] == "//":
 				continue
 			line_stripped = self.strip_lines(line)
-			self.logger.info("Line {0} stripped = {1}".format(line_ctr, line_stripped))
+			self.logger.info("Line %d stripped = %s", line_ctr, line_stripped)
 		# If line contains '=', call the var parser
 			if '=' in line_stripped:
 				cmd = self.var_parser(line_stripped)
@@ -219,8 +228,8 @@ class Assembler:
 			hex_cmds.append(hex_cmd1)
 			line_ctr += 1
 
-			self.logger.info("Hex cmd1 = {}\n".format(hex_cmd1))
-			self.logger.info("Hex cmd2 = {}\n".format(hex_cmd2))
+			self.logger.info("Hex cmd1 = %s\n", hex_cmd1)
+			self.logger.info("Hex cmd2 = %s\n", hex_cmd2)
 
 
 		# Make a byte array of hex commands
@@ -228,7 +237,7 @@ class Assembler:
 
 
 		hex_ints = [int(hex_cmd, 16) for hex_cmd in hex_cmds]
-		self.logger.info("Hex ints = {}\n".format(hex_ints))
+		self.logger.info("Hex ints = %s\n", hex_ints)
 
 		# Convert to byte array
 		b = bytes()
@@ -236,10 +245,10 @@ class Assembler:
 		b = b.join(hex_bytes)
 
 		# Logging
-		self.logger.info("Hex bytes = {}\n".format(hex_bytes))
-		self.logger.info("Length of hex bytes = {}\n".format(len(hex_bytes)))
-		self.logger.info("b = {}".format(b))
-		self.logger.info("Length of byte array = {}".format(len(b)))
+		self.logger.info("Hex bytes = %s\n", hex_bytes)
+		self.logger.info("Length of hex bytes = %d\n", len(hex_bytes))
+		self.logger.info("b = %s", b)
+		self.logger.info("Length of byte array = %d", len(b))
 
 		# # Binary file
 		# with open('out_bin.txt', "w") as out_file:
@@ -273,8 +282,123 @@ class Assembler:
 		return b
 
 
+# Batch assembly: a stateless alternative to Assembler, for building many programs at once. It accepts the same
+# language, without writing any files. Variable addresses are the variable's position in the program.
+_tables = Assembler()
+_opcodes = {k: int(v[0], 2) for k, v in _tables.opcode_table.items()}
+_formats = {k: (v[1] if len(v) > 1 else None) for k, v in _tables.opcode_table.items()}
+_bits = {k: int(v, 16) for k, v in _tables.bit_table.items()}
+_pr_cycles_per_us = 1/(7e-3) # as for Assembler: 7ns clock cycle
+
+@lru_cache(maxsize=4096)
+def _parse_line(line):
+	''' Parse one stripped source line into (opcode, reg, reg_shift, value, delay, symbol, var_name).
+	value is an int, or None if it comes from symbol (a variable's address, or else a hex number); delay is the PR delay in us (or -1, also for
+	delays given in cycles, which are the value).
+	Pure function of the line text, so lines shared between programs are only parsed once. '''
+	if '=' in line:
+		line = line.replace(' ', '')
+		var_name, cmd = line.split('=', 1)
+		value = 0
+		for word in cmd.split('|'):
+			if any(c.isdigit() for c in word):
+				value = int(word, 16) # the first number wins, as for Assembler.var_parser()
+				break
+			if word not in _bits:
+				raise ValueError("Unknown command {}".format(word))
+			value |= _bits[word]
+		return (0, 0, 0, value, -1, None, var_name)
+
+	fields = line.split()
+	opcode = fields[0]
+	if opcode not in _opcodes:
+		raise ValueError("Unknown opcode {}".format(opcode))
+	op, fmt = _opcodes[opcode], _formats[opcode]
+	if fmt is None: # NOP, HALT
+		return (op, 0, 0, 0, -1, None, None)
+	if fmt == 'A':
+		if opcode in ('LD64', 'JNZ'):
+			# The operand is resolved in assemble_batch(): variable names (which may look like hex) come first
+			return (op, int(fields[1], 10), 32, None, -1, fields[2], None)
+		if opcode in ('DEC', 'INC'):
+			return (op, int(fields[1], 10), 32, 0, -1, None, None)
+		return (op, 0, 32, int(fields[1], 16), -1, None, None)
+	if opcode == 'PR':
+		if fields[2].endswith('c'): # delay given in clock cycles
+			return (op, int(fields[1]), 40, int(fields[2][:-1]), -1, None, None)
+		return (op, int(fields[1]), 40, 0, int(fields[2]), None, None)
+	return (op, 0, 0, int(fields[1], 10), -1, None, None) # TXOFFSET, GRADOFFSET
+
+@lru_cache(maxsize=4096)
+def _strip_line(line):
+	comment_index = line.find("//")
+	if comment_index >= 0:
+		line = line[:comment_index]
+	return line.replace(',', '').strip()
+
+def _source_lines(source):
+	''' Stripped code lines of a program given as text or as a list of lines '''
+	if isinstance(source, str):
+		source = source.splitlines()
+	return [line for line in map(_strip_line, source) if line]
+
+def assemble_batch(sources, params=None):
+	''' Assemble many programs in one call.
+
+	sources: list of programs, each given as source text or a list of source lines; or, with params, a single
+	template program with str.format() fields, e.g. "PR 5, {rf_len}"
+	params: list of dicts of template fields, one per variant
+
+	Returns (table, lengths, symbols):
+	table: (programs x words) uint32 array; row k holds program k as little-endian 32-bit words, two per
+	instruction (low word first), zero-padded to the longest program. table[k, :lengths[k]].tobytes() is the
+	same as Assembler().assemble() for the program.
+	lengths: number of words in each program
+	symbols: per-program dicts of variable name: address (instruction index)
+	'''
+	if params is not None:
+		# Strip comments before formatting, so only code lines are substituted
+		template = "\n".join(_source_lines(sources))
+		sources = [template.format(**p) for p in params]
+
+	rows, lengths, symbols = [], [], []
+	for k, source in enumerate(sources):
+		lines = _source_lines(source)
+		sym = {}
+		for pc, line in enumerate(lines):
+			try:
+				row = _parse_line(line)
+				if row[5] is not None:
+					# As for Assembler: a defined variable takes precedence over a hex address
+					try:
+						addr = sym[row[5]] if row[5] in sym else int(row[5], 16)
+					except ValueError:
+						raise ValueError("Invalid hexadecimal number or undefined variable {}".format(row[5]))
+					row = row[:3] + (addr,) + row[4:]
+			except (ValueError, IndexError) as e:
+				raise ValueError("program {:d}, instruction {:d} ({}): {}".format(k, pc, line, e)) from None
+			if row[6] is not None:
+				sym[row[6]] = pc
+			rows.append(row)
+		lengths.append(2 * len(lines))
+		symbols.append(sym)
+	lengths = np.array(lengths, dtype=int)
+
+	# Encode every instruction of every program at once
+	op, reg, shift, value = (np.array([r[i] for r in rows], np.uint64) for i in range(4))
+	delay = np.array([r[4] for r in rows], float)
+	pr = delay >= 0
+	value[pr] = np.floor(delay[pr] * _pr_cycles_per_us).astype(np.uint64)
+	words = (op << np.uint64(58)) | (reg << shift) | value
+
+	table = np.zeros((len(lengths), lengths.max(initial=0)), np.uint32)
+	mask = np.arange(table.shape[1]) < lengths[:, None]
+	table[mask] = words.astype('<u8').view('<u4')
+	return table, lengths, symbols
+
 # Sample usage
 if __name__ == "__main__":
+	logging.basicConfig(filename = 'assembler.log', filemode = 'w', level = logging.DEBUG)
 	a = Assembler()
 	inp_file = 'sequence/basic/se_default.txt'
 	hex_bytes = a.assemble(inp_file)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+#
+# Incremental k-space assembly and FFT reconstruction. Each shot's readout is placed into a preallocated k-space
+# array as soon as it arrives, and partial reconstructions are run on a background thread so a preview image is
+# available during the scan; the final image is ready as soon as the last line has been added.
+
+import itertools, threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.fft as fft
+
+def _roll_into(out, x, shift):
+    """ out[...] = np.roll(x, shift) over every axis, without the temporary array np.roll (or fft.fftshift)
+    allocates: each axis is copied in two blocks """
+    blocks = []
+    for n, s in zip(x.shape, shift):
+        s %= n
+        blocks.append(((slice(n - s, n), slice(0, s)), (slice(0, n - s), slice(s, n)))) # (source, destination)
+    for b in itertools.product(*blocks):
+        np.copyto(out[tuple(d for _, d in b)], x[tuple(src for src, _ in b)])
+    return out
+
+class ReconPlan:
+    """ Reusable reconstruction state for one k-space geometry.
+
+    shape: k-space shape; the readout is the last axis
+    workers: number of threads scipy.fft may use for each transform (-1 for all cores)
+
+    Plans are shared between scans of the same geometry via recon_plan(), so the scratch buffer is only allocated
+    once and scipy's internal FFT plan cache stays warm.
+    """
+
+    def __init__(self, shape, workers=-1):
+        self.shape = tuple(shape)
+        self.workers = workers
+        self.axes = tuple(range(len(self.shape)))
+        self.scratch = np.empty(self.shape, np.complex64)
+        self.lock = threading.Lock()
+
+    def execute(self, kspace):
+        """ Reconstruct a complex image from a centred k-space array """
+        with self.lock:
+            # ifftshift straight into the scratch buffer, which the FFT may then overwrite
+            _roll_into(self.scratch, kspace, [-(n // 2) for n in self.shape])
+            img = fft.ifftn(self.scratch, axes=self.axes, overwrite_x=True, workers=self.workers)
+            return _roll_into(np.empty(self.shape, img.dtype), img, [n // 2 for n in self.shape])
+
+_plans = {}
+_plans_lock = threading.Lock()
+
+def recon_plan(shape, workers=-1):
+    """ Return the cached ReconPlan for this geometry, creating it on first use """
+    key = (tuple(shape), workers)
+    with _plans_lock:
+        try:
+            return _plans[key]
+        except KeyError:
+            plan = _plans[key] = ReconPlan(shape, workers)
+            return plan
+
+class Reconstructor:
+    """ Assembles k-space line by line and reconstructs it incrementally.
+
+    shape: k-space shape, e.g. (phase_encodes, readout) or (slice_encodes, phase_encodes, readout)
+    ro_offset: index of the first readout sample to use from each acquired line (to skip samples acquired
+    before the echo window); shape[-1] samples are used from there on
+    preview_every: run a partial reconstruction in the background after this many new lines
+    workers: threads used by scipy.fft for each transform (-1 for all cores)
+    """
+
+    def __init__(self, shape, ro_offset=0, preview_every=8, workers=-1):
+        self.shape = tuple(shape)
+        self.ro_offset = ro_offset
+        self.preview_every = preview_every
+
+        self.kspace = np.zeros(self.shape, np.complex64)
+        self.acquired = np.zeros(self.shape[:-1], bool)
+        self.plan = recon_plan(self.shape, workers)
+
+        self.preview = None # magnitude image from the most recent partial reconstruction
+        self.lines_in_preview = 0
+
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        self._new_lines = 0
+
+    def add_line(self, pe_idx, data):
+        """ pe_idx: phase-encode index (an int, or a tuple for 3D k-space)
+        data: readout samples returned by Experiment.run() for that phase encode
+        """
+        n_ro = self.shape[-1]
+        line = data[self.ro_offset:self.ro_offset + n_ro]
+        assert line.size == n_ro, "Readout too short: need {:d} samples after offset {:d}".format(n_ro, self.ro_offset)
+
+        with self._lock:
+            self.kspace[pe_idx] = line
+            self.acquired[pe_idx] = True
+        self._new_lines += 1
+
+        if self._new_lines >= self.preview_every and (self._pending is None or self._pending.done()):
+            self._new_lines = 0
+            self._pending = self._pool.submit(self._update_preview)
+
+    def _snapshot(self):
+        with self._lock:
+            return self.kspace.copy(), int(np.count_nonzero(self.acquired))
+
+    def _update_preview(self):
+        kspace, lines = self._snapshot()
+        self.preview = np.abs(self.plan.execute(kspace))
+        self.lines_in_preview = lines
+
+    def reconstruct(self):
+        """ Reconstruct the k-space acquired so far (missing lines are zero-filled); returns a complex image """
+        kspace, _ = self._snapshot()
+        return self.plan.execute(kspace)
+
+    def finish(self):
+        """ Wait for any background preview, then return the final complex image """
+        if self._pending is not None:
+            self._pending.result()
+        self._pool.shutdown()
+        img = self.reconstruct()
+        self.preview = np.abs(img)
+        self.lines_in_preview = int(np.count_nonzero(self.acquired))
+        return img
+
+def test_Reconstructor():
+    # Simulated 2D scan: a square phantom, one phase-encode line per shot in centric order
+    n_pe, n_ro = 64, 128
+    phantom = np.zeros((n_pe, n_ro), np.complex64)
+    phantom[16:48, 32:96] = 1
+    kspace = fft.fftshift(fft.fftn(fft.ifftshift(phantom)))
+
+    rec = Reconstructor((n_pe, n_ro), preview_every=16)
+    order = np.argsort(np.abs(np.arange(n_pe) - n_pe // 2), kind='stable')
+    for pe in order:
+        data = kspace[pe] # in a real scan, this would be Experiment.run()
+        rec.add_line(pe, data)
+
+    img = rec.finish()
+    print("max reconstruction error: {:e}".format(np.max(np.abs(img - phantom))))
+    assert np.allclose(img, phantom, rtol=0, atol=1e-5)
+
+if __name__ == "__main__":
+    test_Reconstructor()
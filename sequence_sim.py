@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#
+# Offline simulator for assembled pulse sequences. Executes the machine code produced by Assembler.assemble()
+# (LD64, PR delays, DEC/INC/JNZ/J loops, TXOFFSET/GRADOFFSET, HALT) and returns a Timeline of output events,
+# from which gate timelines, the total duration and the number of RX samples the sequence will produce are
+# computed with vectorised NumPy operations. Use it to size Experiment(samples=...) before spending hardware time.
+#
+# Timing model: only PR instructions take time, i.e. R[reg] is output for the encoded number of FPGA clock
+# cycles. Note that the assembler converts PR delays to cycles assuming a 7 ns clock, so a PR of N us lasts
+# N * (1 / 7e-3) / fpga_clk_freq_MHz us on the hardware; the Timeline reports the true durations.
+#
+# RX sample counts assume the receiver delivers one sample per rx_decimation * rx_div FPGA clocks, i.e. every
+# rx_decimation * Experiment.rx_t us. This is the unexplained 2x that test_acquire.py's rx_sample_period and the
+# "sampling rate is off by 2x" note in experiment.test_grad_echo() allow for; it hasn't been checked against a
+# hardware sample count. For grad_echo.txt at rx_t = 0.5 us this gives 2459 samples, against the hand-tuned 2110
+# (1900 + 210 us of RX at 1 us per sample): the difference is the 7 ns clock assumed by the assembler.
+
+import numpy as np
+
+import server_comms as sc
+
+# Opcodes, as in ocra_lib.assembler.Assembler.opcode_table
+NOP, DEC, INC, LD64 = 0b000000, 0b000001, 0b000010, 0b000100
+TXOFFSET, GRADOFFSET = 0b001000, 0b001001
+JNZ, BTR, RET, J = 0b010000, 0b010100, 0b010101, 0b010111
+HALT, PI, PR = 0b011001, 0b011100, 0b011101
+
+# Output bits, as in Assembler.bit_table
+TX_PULSE, RX_PULSE, GRAD_PULSE, TX_GATE, RX_GATE = 0x01, 0x02, 0x04, 0x10, 0x20
+
+reg_count = 32
+rx_decimation = 2 # see the note at the top
+mask32 = (1 << 32) - 1
+mask40 = (1 << 40) - 1
+
+def decode(machine_code):
+    """ Split assembled machine code (bytes from Assembler.assemble, or a uint64 array) into opcode, register and
+    argument arrays, one element per instruction word """
+    words = np.frombuffer(machine_code, '<u8') if isinstance(machine_code, (bytes, bytearray)) \
+        else np.asarray(machine_code, np.uint64)
+    opcode = (words >> np.uint64(58)).astype(np.int64)
+    is_b = (opcode == PR) | (opcode == TXOFFSET) | (opcode == GRADOFFSET)
+    reg = np.where(is_b, (words >> np.uint64(40)) & np.uint64(0x3ffff),
+                   (words >> np.uint64(32)) & np.uint64(0x1f)).astype(np.int64)
+    arg = np.where(is_b, words & np.uint64(mask40), words & np.uint64(mask32)).astype(np.int64)
+    return words, opcode, reg, arg
+
+class Timeline:
+    """ Output events of a simulated sequence, as parallel arrays with one element per PR instruction executed.
+
+    start, duration: in FPGA clock cycles
+    output: value of the output register (gate bits in the low byte)
+    tx_offset, grad_offset: TX and gradient BRAM offsets in effect during each event
+    """
+
+    def __init__(self, start, duration, output, tx_offset, grad_offset, clk_freq_MHz=sc.fpga_clock_freq_MHz):
+        self.start = start
+        self.duration = duration
+        self.output = output
+        self.tx_offset = tx_offset
+        self.grad_offset = grad_offset
+        self.clk_freq_MHz = clk_freq_MHz
+
+    def __len__(self):
+        return self.start.size
+
+    @property
+    def cycles(self):
+        """ total sequence duration in clock cycles """
+        return int(self.start[-1] + self.duration[-1]) if len(self) else 0
+
+    @property
+    def duration_us(self):
+        return self.cycles / self.clk_freq_MHz
+
+    def active(self, bit, active_low=False):
+        """ boolean array: whether an output bit is active during each event; note that RX_PULSE is active-low """
+        on = (self.output & bit) != 0
+        return ~on if active_low else on
+
+    def windows(self, active):
+        """ (start, stop) cycle arrays of the contiguous spans where 'active' (per-event boolean array) is True """
+        a = np.concatenate([[False], active & (self.duration > 0), [False]]).astype(np.int8)
+        edges = np.diff(a)
+        first, last = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+        return self.start[first], self.start[last] + self.duration[last]
+
+    def rx_windows(self):
+        return self.windows(self.active(RX_PULSE, active_low=True))
+
+    def rx_samples(self, rx_t, decimation=None):
+        """ number of RX samples the sequence produces, for an RX sample period of rx_t us as set with rx_rate
+        (e.g. Experiment.rx_t); the receiver outputs one sample every decimation * rx_t us (default rx_decimation) """
+        decimation = rx_decimation if decimation is None else decimation
+        start, stop = self.rx_windows()
+        rx_cycles = decimation * rx_t * self.clk_freq_MHz
+        return int(np.sum(np.floor((stop - start) / rx_cycles)))
+
+    def sample(self, t_us):
+        """ output register values at the times t_us (array); zero after the end of the sequence """
+        cyc = np.asarray(t_us) * self.clk_freq_MHz
+        idx = np.searchsorted(self.start, cyc, side='right') - 1
+        idx = np.clip(idx, 0, len(self) - 1)
+        inside = (cyc >= 0) & (cyc < self.start[idx] + self.duration[idx])
+        return np.where(inside, self.output[idx], 0)
+
+def simulate(machine_code, clk_freq_MHz=sc.fpga_clock_freq_MHz, max_steps=10_000_000):
+    """ Execute assembled machine code and return its Timeline.
+
+    max_steps: limit on the number of instructions executed, to catch sequences that never HALT
+    """
+    words, opcode, reg, arg = decode(machine_code)
+    # Plain Python lists/ints for the interpreter loop; indexing NumPy scalars is several times slower
+    words, opcode, reg, arg = words.tolist(), opcode.tolist(), reg.tolist(), arg.tolist()
+    n = len(words)
+
+    R = [0] * reg_count
+    starts, durations, outputs, tx_offs, grad_offs = [], [], [], [], []
+    t = tx_off = grad_off = 0
+    pc = steps = 0
+    while True:
+        if pc >= n:
+            raise ValueError("Program counter ran off the end of the program at address {:#x}".format(pc))
+        steps += 1
+        if steps > max_steps:
+            raise RuntimeError("Sequence did not HALT within {:d} instructions".format(max_steps))
+
+        op, a = opcode[pc], arg[pc]
+        pc += 1
+        if op == PR:
+            starts.append(t)
+            durations.append(a)
+            outputs.append(R[reg[pc - 1]])
+            tx_offs.append(tx_off)
+            grad_offs.append(grad_off)
+            t += a
+        elif op == LD64:
+            R[reg[pc - 1]] = words[a] if a < n else 0 # memory beyond the program is treated as zeroed
+        elif op == DEC:
+            R[reg[pc - 1]] = (R[reg[pc - 1]] - 1) & ((1 << 64) - 1)
+        elif op == INC:
+            R[reg[pc - 1]] = (R[reg[pc - 1]] + 1) & ((1 << 64) - 1)
+        elif op == JNZ:
+            if R[reg[pc - 1]] != 0:
+                pc = a
+        elif op == J:
+            pc = a
+        elif op == TXOFFSET:
+            tx_off = a
+        elif op == GRADOFFSET:
+            grad_off = a
+        elif op == HALT:
+            break
+        elif op == NOP:
+            pass
+        else:
+            raise ValueError("Unsupported opcode {:#08b} at address {:#x}".format(op, pc - 1))
+
+    return Timeline(np.array(starts, np.int64), np.array(durations, np.int64), np.array(outputs, np.uint64),
+                    np.array(tx_offs, np.int64), np.array(grad_offs, np.int64), clk_freq_MHz)
+
+def test_simulate():
+    from ocra_lib.assembler import assemble_batch # unlike Assembler, doesn't write hex files into ocra_lib
+    for f in ("ocra_lib/grad_echo.txt", "ocra_lib/se_default_vn.txt"):
+        with open(f) as src:
+            table, lengths, _ = assemble_batch([src.read()])
+        tl = simulate(table[0, :lengths[0]].tobytes())
+        rx_start, rx_stop = tl.rx_windows()
+        print("{:s}: {:d} events, {:.1f} us total, RX windows (us): {}".format(
+            f, len(tl), tl.duration_us, list(zip((rx_start / tl.clk_freq_MHz).tolist(), (rx_stop / tl.clk_freq_MHz).tolist()))))
+        print("  samples needed at rx_t = 0.5 us: {:d}".format(tl.rx_samples(0.5)))
+
+if __name__ == "__main__":
+    test_simulate()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import collections, socket, sys, threading, time, warnings, zlib
 import msgpack
 
 version_major = 0
@@ -14,62 +15,588 @@ reply_pkt = 128
 
 fpga_clock_freq_MHz = 122.88
 
-def construct_packet(data, packet_idx=0, command=request_pkt, version=(version_major, version_minor, version_debug)):
+# BRAM capacities in samples; each TX sample (I,Q) and each gradient sample takes 4 bytes
+tx_bram_samples = 16384 # 64 KiB of raw_tx_data
+grad_bram_samples = 2048 # 8192 bytes per grad_mem_* channel
+
+grad_t = 10 # gradient DAC update period in us; fixed in the current firmware
+
+acq_max_samples = 16384 # largest acq in one request: the depth of the server's RX FIFO
+
+# Payload compression: large binary fields may be sent as msgpack extension types, if the server agreed to it
+# in reply to a 'compression' request (see negotiate_compression()). Servers that don't support compression
+# reply -1 to the unknown request, so fields are then always sent raw.
+zlib_ext = 1 # zlib stream
+rle_ext = 2 # run-length encoding over little-endian 32-bit words: (count, word) pairs
+compression_methods = ('rle', 'zlib')
+
+def rle_encode(data):
+    import numpy as np
+    w = np.frombuffer(data, '<u4')
+    if w.size == 0:
+        return b''
+    starts = np.concatenate([[0], np.flatnonzero(w[1:] != w[:-1]) + 1])
+    counts = np.diff(np.append(starts, w.size))
+    return np.stack([counts.astype('<u4'), w[starts]], axis=1).tobytes()
+
+def rle_decode(payload):
+    import numpy as np
+    pairs = np.frombuffer(payload, '<u4').reshape(-1, 2)
+    return np.repeat(pairs[:, 1], pairs[:, 0]).astype('<u4').tobytes()
+
+_ext_codes = {'zlib': zlib_ext, 'rle': rle_ext}
+_encoders = {'zlib': lambda b: zlib.compress(b, 1), 'rle': rle_encode}
+_decoders = {zlib_ext: zlib.decompress, rle_ext: rle_decode}
+
+def decompress_ext(code, payload):
+    """ msgpack ext_hook restoring compressed fields, for use on the receiving side """
+    try:
+        return _decoders[code](payload)
+    except KeyError:
+        return msgpack.ExtType(code, payload)
+
+class Compressor:
+    """ Per-field compression policy for construct_packet().
+
+    Binary fields of at least min_bytes are compressed when the estimated upload time saved over a link of
+    link_MBps outweighs the time spent compressing. The compression ratio and speed of each method are measured per
+    field name on a probe, and the best method is reused for that field until the next probe, every probe_every
+    packets. Fields that didn't compress well enough are sent raw until then.
+
+    link_MBps is the upload throughput of the link to the server, which decides how much compression pays off. The
+    default is only a guess for a 100 Mbit/s link: measure it with calibrate_link() once connected (or take it from
+    net_bench.py's fit for raw_tx_data).
+    methods stays empty (everything is sent raw) until negotiate_compression() succeeds; negotiated records whether
+    it has been tried.
+    bytes_in, bytes_out: totals over the binary fields considered, before and after compression
+    """
+
+    def __init__(self, link_MBps=10, methods=compression_methods, min_bytes=4096, probe_every=32):
+        self.link_MBps = link_MBps
+        self.wanted = tuple(methods)
+        self.methods = ()
+        self.negotiated = False
+        self.min_bytes = min_bytes
+        self.probe_every = probe_every
+        self.stats = {} # field: {'method': chosen method or None, 'ratio': compressed/raw size, 'age'}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _upload_time(self, n):
+        return n / (self.link_MBps * 1e6)
+
+    def _probe(self, key, raw):
+        """ try every usable method on raw; returns the fastest (method, payload) overall, or (None, raw) """
+        n = len(raw)
+        best, best_t = (None, raw), self._upload_time(n)
+        for m in self.methods:
+            if m == 'rle' and n % 4:
+                continue
+            t = time.perf_counter()
+            comp = _encoders[m](raw)
+            t = time.perf_counter() - t + self._upload_time(len(comp))
+            if t < best_t:
+                best, best_t = (m, comp), t
+        self.stats[key] = {'method': best[0], 'ratio': len(best[1]) / n, 'age': 0}
+        return best
+
+    def encode_field(self, key, raw):
+        """ raw bytes, or a msgpack ExtType holding them compressed """
+        st = self.stats.get(key)
+        if st is None or st['age'] >= self.probe_every:
+            method, out = self._probe(key, raw)
+        else:
+            st['age'] += 1
+            method, out = st['method'], raw
+            if method is not None:
+                t = time.perf_counter()
+                out = _encoders[method](raw)
+                t = time.perf_counter() - t
+                st['ratio'] = len(out) / len(raw)
+                if t + self._upload_time(len(out)) >= self._upload_time(len(raw)):
+                    st['age'] = self.probe_every # no longer pays off; re-probe on the next packet
+                    method, out = None, raw
+        self.bytes_in += len(raw)
+        self.bytes_out += len(out)
+        return raw if method is None else msgpack.ExtType(_ext_codes[method], out)
+
+    def encode(self, data):
+        """ copy of a request dict with its large binary fields compressed where worthwhile """
+        if not self.methods or not isinstance(data, dict):
+            return data
+        return {k: self.encode_field(k, bytes(v))
+                if isinstance(v, (bytes, bytearray, memoryview)) and len(v) >= self.min_bytes else v
+                for k, v in data.items()}
+
+def construct_packet(data, packet_idx=0, command=request_pkt, version=(version_major, version_minor, version_debug),
+                     compressor=None):
     vma, vmi, vd = version
     assert vma < 256 and vmi < 256 and vd < 256, "Version is too high for a byte!"
     version = (vma << 16) | (vmi << 8) | vd
+    if compressor is not None:
+        data = compressor.encode(data)
     fields = [command, packet_idx, 0, version, data]
     return fields
 
+class Reply:
+    """ Server reply, parsed without copying or formatting anything.
+
+    results: {request key: result}; settings and uploads give integer result codes (0 for success, negative on
+    failure), while data requests (acq, test_throughput) give their data
+    infos, warnings, errors: status messages from the server (empty if there were none)
+    """
+
+    __slots__ = ('command', 'packet_idx', 'version', 'results', 'infos', 'warnings', 'errors')
+
+    def __init__(self, payload):
+        self.command, self.packet_idx, _, self.version = payload[:4]
+        results = payload[4] if len(payload) > 4 else None
+        self.results = results if isinstance(results, dict) else {}
+        status = payload[5] if len(payload) > 5 and isinstance(payload[5], dict) else {}
+        self.infos = status.get('infos', ())
+        self.warnings = status.get('warnings', ())
+        self.errors = status.get('errors', ())
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def code(self, key):
+        """ result code for a request key, or None for data results and keys that weren't in the reply """
+        v = self.results.get(key)
+        return v if type(v) is int else None
+
+    @property
+    def failed(self):
+        """ request keys with negative result codes """
+        return [k for k, v in self.results.items() if type(v) is int and v < 0]
+
+    def __getitem__(self, key):
+        return self.results[key]
+
+    def __repr__(self):
+        return "Reply({:s}; {:d} infos, {:d} warnings, {:d} errors)".format(
+            _summarise(self.results), len(self.infos), len(self.warnings), len(self.errors))
+
+def _summarise(results):
+    """ one-line description of reply results, with data replaced by its size """
+    def desc(v):
+        if isinstance(v, (bytes, bytearray)):
+            return "<{:d} bytes>".format(len(v))
+        if isinstance(v, (list, tuple)):
+            return "<{:d} items>".format(len(v))
+        if isinstance(v, dict):
+            return "{" + ", ".join("{}: {}".format(k, desc(x)) for k, x in v.items()) + "}"
+        return repr(v)
+    return "{" + ", ".join("{}: {}".format(k, desc(v)) for k, v in results.items()) + "}"
+
+class ReplyStats:
+    """ Counters over the replies of a run: replies, total infos/warnings/errors, and failures per request key """
+
+    def __init__(self):
+        self.replies = 0
+        self.infos = 0
+        self.warnings = 0
+        self.errors = 0
+        self.failed = collections.Counter()
+
+    def add(self, reply):
+        self.replies += 1
+        self.infos += len(reply.infos)
+        self.warnings += len(reply.warnings)
+        self.errors += len(reply.errors)
+        if reply.errors:
+            self.failed.update(reply.failed)
+
+    def __repr__(self):
+        return "ReplyStats({:d} replies: {:d} infos, {:d} warnings, {:d} errors; failed keys {})".format(
+            self.replies, self.infos, self.warnings, self.errors, dict(self.failed))
+
+class Reporter:
+    """ Opt-in printing of replies.
+
+    level: least severe status messages printed: 'errors', 'warnings' or 'infos'
+    data: also print a summary of the results (sizes only for data, never its contents)
+    stream: file to print to (default sys.stdout at the time of printing)
+    """
+
+    _levels = ('errors', 'warnings', 'infos')
+
+    def __init__(self, level='warnings', data=False, stream=None):
+        self.kinds = self._levels[:self._levels.index(level) + 1]
+        self.data = data
+        self.stream = stream
+
+    def __call__(self, reply):
+        lines = ["{:s}: {}".format(kind[:-1], msg) for kind in self.kinds for msg in getattr(reply, kind)]
+        if self.data:
+            lines.append("results: " + _summarise(reply.results))
+        if lines:
+            print("\n".join(lines), file=self.stream or sys.stdout)
+
+def parse_reply(payload, stats=None, reporter=None):
+    """ Reply for a raw reply payload, counted in stats (ReplyStats) and passed to reporter (Reporter) if given """
+    reply = Reply(payload)
+    if stats is not None:
+        stats.add(reply)
+    if reporter is not None:
+        reporter(reply)
+    return reply
+
 def process(payload, print_all=False):
-    # data = msgpack.unpackb(raw_reply, use_list=False, max_array_len=1024*1024)
-    reply_data = payload[4]
+    """ Print a reply's errors (all its status messages with print_all) and a summary of its results; returns the
+    Reply. For loops, use parse_reply() with a Reporter, or no reporter at all. """
+    reply = Reply(payload)
+    Reporter('infos' if print_all else 'errors', data=True)(reply)
+    return reply
 
-    if print_all:
-        print("")
-        
-        status = payload[5]
+def send_packet(packet, socket, timeout=None):
+    # socket: a connected socket, or a Connection/ReplayConnection
+    # timeout: seconds allowed for each socket operation; raises TimeoutError when exceeded (see Connection for
+    # deadlines, cancellation and pipelining). The socket's own timeout is restored afterwards.
+    # After a timeout on a plain socket, the late reply is still on its way and would be taken as the reply to the
+    # next request, so the socket has to be closed; a Connection discards abandoned replies instead.
+    if isinstance(socket, (Connection, ReplayConnection)):
+        return socket.transact(packet, timeout)
+    previous = socket.gettimeout()
+    if timeout is not None:
+        socket.settimeout(timeout)
+    try:
+        socket.sendall(msgpack.packb(packet))
 
-        try:
-            print("Errors:")
-            for k in status['errors']:
-                print(k)
-        except KeyError:
-            pass
+        unpacker = msgpack.Unpacker()
+        packet_done = False
+        while not packet_done:
+            buf = socket.recv(1024)
+            if not buf:
+                break
+            unpacker.feed(buf)
+            for o in unpacker: # ugly way of doing it
+                return o # quit function after 1st reply (could make this a thread in the future)
+    finally:
+        socket.settimeout(previous)
+
+class Cancelled(Exception):
+    """ a request was cancelled with Connection.cancel() """
 
+class Connection:
+    """ Persistent client connection with a single reply unpacker, so that several requests can be in flight.
+
+    sock_or_address: a connected socket, or a (host, port) to connect to
+    recv_bytes: socket read size; large replies (acq data) arrive in far fewer reads than with send_packet()
+    timeout: default deadline for each send() and recv(), in seconds (None: wait indefinitely)
+    poll_interval: how often a waiting recv() checks for cancellation, in seconds
+    record: path of a traffic log to write, for replay with ReplayConnection (None: no recording)
+
+    send() and recv() may be interleaved freely; replies come back in request order. A recv() that times out or is
+    cancelled abandons its request: the reply is discarded when it arrives, so later replies still match up with
+    their requests. A send() that times out may leave a partial packet behind, after which the connection has to be
+    closed. Requests are numbered in the order they are sent (self.sent counts them, and self.received counts their
+    replies), which is how cancel() tells the requests it applies to from later ones.
+    """
+
+    def __init__(self, sock_or_address, recv_bytes=1 << 18, timeout=None, poll_interval=0.02, record=None):
+        if isinstance(sock_or_address, tuple):
+            sock_or_address = socket.create_connection(sock_or_address, timeout)
+        self.socket = sock_or_address
         try:
-            print("Warnings:")
-            for k in status['warnings']:
-                print(k)
-        except KeyError:
-            pass
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (OSError, AttributeError):
+            pass # not a TCP socket
+        self.recv_bytes = recv_bytes
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.unpacker = msgpack.Unpacker(max_buffer_size=0)
+        self.pending = 0 # requests sent whose replies haven't been read yet
+        self.discard = 0 # abandoned requests whose replies are still to come
+        self.sent = self.received = 0
+        self.cancel_before = 0 # requests numbered below this are cancelled, unless their reply has arrived
+        self.log = None if record is None else _TrafficLog(record)
+
+    def cancel(self):
+        """ cancel the requests in flight: a recv() waiting for one of them (in progress, or a later call) raises
+        Cancelled, unless its reply has already arrived. Requests sent afterwards aren't affected, and nothing
+        happens if no request is in flight. May be called from any thread. """
+        self.cancel_before = self.sent
+
+    def send(self, packet, timeout=None):
+        self.socket.settimeout(self.timeout if timeout is None else timeout)
+        self.socket.sendall(msgpack.packb(packet))
+        self.sent += 1
+        self.pending += 1
+        if self.log is not None:
+            self.log.write(_sent, packet)
+
+    def recv(self, timeout=None):
+        """ next reply; raises TimeoutError if none arrives within timeout seconds (default self.timeout), or
+        Cancelled if cancel() is called meanwhile """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for reply in self.unpacker:
+                self.received += 1
+                self.pending -= 1
+                if self.log is not None:
+                    self.log.write(_received, reply)
+                if self.discard:
+                    self.discard -= 1
+                    continue
+                return reply
+            # If the request being waited for was cancelled, only what has already arrived is read
+            cancelled = self.received + self.discard < self.cancel_before
+            wait = 0 if cancelled else self.poll_interval
+            if deadline is not None and not cancelled:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    self.discard += 1
+                    raise TimeoutError("no reply from the server within {:.3f} s".format(timeout))
+            self.socket.settimeout(wait)
+            try:
+                buf = self.socket.recv(self.recv_bytes)
+            except (socket.timeout, BlockingIOError):
+                if cancelled:
+                    self.discard += 1
+                    raise Cancelled("request cancelled")
+                continue
+            if not buf:
+                raise ConnectionError("server closed the connection")
+            self.unpacker.feed(buf)
+
+    def transact(self, packet, timeout=None):
+        self.send(packet, timeout)
+        return self.recv(timeout)
+
+    def close(self):
+        self.socket.close()
+        if self.log is not None:
+            self.log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Traffic logs are a msgpack stream: a header [log_magic, log_version, version_full], then one [t, direction,
+# packet] record per packet, t being seconds since the log was opened
+log_magic = 'marcos-traffic'
+log_version = 1
+_sent, _received = 0, 1
+
+class _TrafficLog:
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.packer = msgpack.Packer()
+        self.file.write(self.packer.pack([log_magic, log_version, version_full]))
+        self.t0 = time.perf_counter()
+
+    def write(self, direction, packet):
+        self.file.write(self.packer.pack([time.perf_counter() - self.t0, direction, packet]))
+
+    def close(self):
+        self.file.close()
+
+class ReplayConnection:
+    """ Stand-in for a Connection that serves the replies from a traffic log recorded with Connection(record=...),
+    without a server.
+
+    timing: if True, each reply is held back until the recorded time between its request and the reply has elapsed
+    since the matching send(); otherwise replies are returned at once
+    check: if True, warn (and count in self.mismatches) when a packet sent differs from the recorded one
+
+    Requests are matched to the recording by order, so the client has to send the same sequence of requests.
+    """
+
+    def __init__(self, path, timing=False, check=True):
+        self.file = open(path, 'rb')
+        self.unpacker = msgpack.Unpacker(self.file, ext_hook=decompress_ext, max_buffer_size=0)
+        header = next(self.unpacker, None)
+        if not (isinstance(header, list) and header[:2] == [log_magic, log_version]):
+            self.file.close()
+            raise ValueError("{} is not a MaRCoS traffic log".format(path))
+        self.timing = timing
+        self.check = check
+        self.mismatches = 0
+        self.records = (collections.deque(), collections.deque()) # recorded (t, packet) not yet replayed
+        self.sends = collections.deque() # (replay time, recorded time) of sends awaiting a reply
+        self.pending = 0
+        self.discard = 0
+        self.sent = self.received = 0
+        self.cancel_before = 0
+        self.cancelled = threading.Event() # wakes up a timed recv() on cancel()
+
+    def _next(self, direction):
+        queue = self.records[direction]
+        while not queue:
+            try:
+                t, d, packet = next(self.unpacker)
+            except StopIteration:
+                raise EOFError("end of the recorded traffic")
+            self.records[d].append((t, packet))
+        return queue.popleft()
 
+    def cancel(self):
+        self.cancel_before = self.sent
+        self.cancelled.set()
+
+    def send(self, packet, timeout=None):
+        t, recorded = self._next(_sent)
+        # Compare the packets as decoded by the server, since compression choices depend on timing
+        if self.check and msgpack.unpackb(msgpack.packb(packet), ext_hook=decompress_ext) != recorded:
+            self.mismatches += 1
+            warnings.warn("packet {:d} differs from the recording".format(self.mismatches))
+        self.sends.append((time.monotonic(), t))
+        self.sent += 1
+        self.pending += 1
+
+    def recv(self, timeout=None):
+        while True:
+            t, reply = self._next(_received)
+            sent, t_sent = self.sends.popleft() if self.sends else (time.monotonic(), t)
+            seq = self.received
+            self.received += 1
+            self.pending -= 1
+            if self.discard:
+                self.discard -= 1
+                continue
+            # With timing, the reply arrives at its recorded delay after the send, and can be cancelled until then
+            while self.timing:
+                if seq < self.cancel_before:
+                    raise Cancelled("request cancelled")
+                wait = sent + t - t_sent - time.monotonic()
+                if wait <= 0:
+                    break
+                self.cancelled.wait(wait)
+                self.cancelled.clear()
+            return reply
+
+    def transact(self, packet, timeout=None):
+        self.send(packet, timeout)
+        return self.recv(timeout)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class EmergencyStop:
+    """ Out-of-band emergency stop: a dedicated connection that sends emergency_stop_pkt without waiting behind
+    the requests in flight on the main connection. Create it before starting the sequence, so that stop() doesn't
+    have to connect first.
+
+    address: (host, port) of the server
+    timeout: deadline for the server's acknowledgement, in seconds
+
+    self.latencies holds the time from each stop() call to the server's acknowledgement, in seconds.
+    """
+
+    def __init__(self, address, timeout=1):
+        self.conn = Connection(address, timeout=timeout)
+        self.latencies = []
+
+    def stop(self, cancel=()):
+        """ Send the emergency stop and wait for the acknowledgement; returns the reply.
+
+        cancel: Connections whose requests in flight are cancelled once the stop is acknowledged (or has failed);
+        requests whose (usually aborted) replies have arrived by then aren't affected
+        """
+        t = time.perf_counter()
         try:
-            print("Infos:")
-            for k in status['infos']:
-                print(k)
-        except KeyError:
-            pass
+            reply = self.conn.transact(construct_packet({}, command=emergency_stop_pkt))
+            self.latencies.append(time.perf_counter() - t)
+        finally:
+            for c in cancel:
+                c.cancel()
+        return reply
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
+def acquire_chunks(conn, samples, chunk=acq_max_samples, depth=4, data=None, packet_idx=0):
+    """ Acquire samples RX samples in back-to-back 'acq' requests of at most chunk samples, with up to depth
+    requests in flight so the server never waits for the client. Yields each chunk's data as a complex64 array.
+
+    conn: Connection; its timeout applies to each chunk
+    data: other request fields (e.g. settings), sent with the first chunk only
+    """
+    import numpy as np
+    sizes = [chunk] * (samples // chunk) + ([samples % chunk] if samples % chunk else [])
+    sent = received = 0
     try:
-        print("Last elements of returned unsigned arrays: {:f}, {:f}".format(
-            payload[4]['test_throughput']['array1'][-1], payload[4]['test_throughput']['array2'][-1]))
-    except KeyError:
-        print("Reply data: ")
-        print(reply_data)
-
-def send_packet(packet, socket):
-    socket.sendall(msgpack.packb(packet))
-
-    unpacker = msgpack.Unpacker()
-    packet_done = False
-    while not packet_done:
-        buf = socket.recv(1024)
-        if not buf:
-            break
-        unpacker.feed(buf)
-        for o in unpacker: # ugly way of doing it
-            return o # quit function after 1st reply (could make this a thread in the future)
+        for k, n in enumerate(sizes):
+            while sent < len(sizes) and sent < k + depth:
+                req = dict(data) if data and sent == 0 else {}
+                req['acq'] = sizes[sent]
+                conn.send(construct_packet(req, packet_idx))
+                sent += 1
+            try:
+                reply = conn.recv()
+            finally:
+                received += 1 # an abandoned recv() discards its own reply
+            acq = reply[4].get('acq') if isinstance(reply[4], dict) else None
+            if not isinstance(acq, bytes):
+                raise RuntimeError("acquisition chunk {:d} failed: {}".format(k, reply[5]))
+            out = np.frombuffer(acq, np.complex64)
+            if out.size != n:
+                raise RuntimeError("acquisition chunk {:d}: expected {:d} samples, got {:d}".format(k, n, out.size))
+            yield out
+    finally:
+        # Abandon the requests still in flight (after an error or cancellation, or if the caller stopped early),
+        # so that the next reply read from conn is the reply to the next request
+        conn.discard += sent - received
+
+def acquire(conn, samples, chunk=acq_max_samples, depth=4, data=None, packet_idx=0):
+    """ Acquire samples RX samples as one contiguous complex64 array, split into pipelined requests as for
+    acquire_chunks() """
+    import numpy as np
+    out = np.empty(samples, np.complex64)
+    pos = 0
+    for c in acquire_chunks(conn, samples, chunk, depth, data, packet_idx):
+        out[pos:pos + c.size] = c
+        pos += c.size
+    return out
+
+def negotiate_compression(socket, compressor, packet_idx=0):
+    """ Ask the server which of compressor.wanted it can decompress, and enable those; returns the agreed methods
+    (empty if the server doesn't support compression). socket may also be a Connection or ReplayConnection. """
+    packet = construct_packet({'compression': list(compressor.wanted)}, packet_idx)
+    reply = send_packet(packet, socket)
+    offered = reply[4].get('compression', -1) if isinstance(reply[4], dict) else -1
+    if not isinstance(offered, (list, tuple)):
+        offered = ()
+    compressor.methods = tuple(m for m in compressor.wanted if m in offered)
+    compressor.negotiated = True
+    return compressor.methods
+
+def calibrate_link(socket, compressor, sizes=(4096, 4 * tx_bram_samples), repeats=5, packet_idx=0):
+    """ Measure the upload throughput of the link with uncompressed raw_tx_data uploads of two sizes, and set
+    compressor.link_MBps from it; returns the throughput in MB/s. The difference between the median round-trip
+    times of the two sizes cancels the per-message overhead. This overwrites the TX BRAM, so do it before uploading
+    the sequence's data. socket may also be a Connection. """
+    times = []
+    for n in sizes:
+        packet = construct_packet({'raw_tx_data': bytes(n)}, packet_idx)
+        t = []
+        for k in range(repeats):
+            t0 = time.perf_counter()
+            send_packet(packet, socket)
+            t.append(time.perf_counter() - t0)
+        times.append(sorted(t)[repeats // 2])
+    dt = times[1] - times[0]
+    if dt > 0:
+        compressor.link_MBps = (sizes[1] - sizes[0]) / dt / 1e6
+    return compressor.link_MBps
 
 def ba_flip_endian(ba):
     # Flip the endianness of the byte array, to suit the server hardware's strange convention
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+#
+# Shared-memory handoff of acquired shots from the acquisition process to analysis processes. The acquisition
+# side publishes each shot's complex64 data into a ring of fixed-size slots in a multiprocessing.shared_memory
+# block, tagged with a sequence number; analysis processes attach to the block by name and read shots as
+# zero-copy NumPy views, so no pickling or copying happens between processes and the socket loop isn't held
+# up by heavy processing.
+#
+# Block layout (all little-endian):
+#   header: int64[4] - next sequence number to be written, number of slots, samples per slot, reserved
+#   slot_seq: int64[slots] - sequence number held by each slot (-1 while empty or being written)
+#   slot_len: int64[slots] - number of valid samples in each slot
+#   data: complex64[slots, samples per slot]
+
+import sys, time
+from multiprocessing import shared_memory
+import numpy as np
+
+header_words = 4
+
+def _layout(buf, slots, slot_samples):
+    header = np.ndarray((header_words,), np.int64, buf, 0)
+    off = header.nbytes
+    slot_seq = np.ndarray((slots,), np.int64, buf, off)
+    off += slot_seq.nbytes
+    slot_len = np.ndarray((slots,), np.int64, buf, off)
+    off += slot_len.nbytes
+    data = np.ndarray((slots, slot_samples), np.complex64, buf, off)
+    return header, slot_seq, slot_len, data
+
+def _block_bytes(slots, slot_samples):
+    return 8 * (header_words + 2 * slots) + 8 * slots * slot_samples
+
+def _attach(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    # Before Python 3.13, attaching registers the block with this process's resource tracker, which unlinks
+    # it when the consumer exits and pulls the ring out from under the producer
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+class ShotRing:
+    """ Producer side of the ring; owns the shared-memory block.
+
+    slots: number of shots held before the oldest is overwritten
+    slot_samples: maximum number of samples per shot
+    name: shared-memory block name (chosen by the OS if None); pass ShotRing.name to consumers
+    """
+
+    def __init__(self, slots=64, slot_samples=8192, name=None):
+        self.slots = slots
+        self.slot_samples = slot_samples
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=_block_bytes(slots, slot_samples))
+        self.name = self.shm.name
+        self.header, self.slot_seq, self.slot_len, self.data = _layout(self.shm.buf, slots, slot_samples)
+        self.header[:] = [0, slots, slot_samples, 0]
+        self.slot_seq[:] = -1
+
+    def publish(self, data):
+        """ data: acquired samples for one shot, e.g. the result of Experiment.run()
+
+        Returns the sequence number of the shot.
+        """
+        n = data.size
+        assert n <= self.slot_samples, "Shot has {:d} samples, ring slots hold {:d}".format(n, self.slot_samples)
+        seq = int(self.header[0])
+        slot = seq % self.slots
+
+        # Invalidate the slot while it's being overwritten, so readers can detect a torn read
+        self.slot_seq[slot] = -1
+        self.data[slot, :n] = data
+        self.slot_len[slot] = n
+        self.slot_seq[slot] = seq
+        self.header[0] = seq + 1
+        return seq
+
+    def close(self):
+        del self.header, self.slot_seq, self.slot_len, self.data
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ShotRingReader:
+    """ Consumer side of the ring, for use in an analysis process.
+
+    name: ShotRing.name of the producer's ring
+
+    Views returned by read() point straight into shared memory and are overwritten once the producer has
+    gone a full ring further; check valid(seq) after processing a view to know whether its data stayed intact,
+    or pass copy=True if the data needs to be kept.
+    """
+
+    def __init__(self, name):
+        self.shm = _attach(name)
+        header = np.ndarray((header_words,), np.int64, self.shm.buf, 0)
+        self.slots, self.slot_samples = int(header[1]), int(header[2])
+        self.header, self.slot_seq, self.slot_len, self.data = _layout(self.shm.buf, self.slots, self.slot_samples)
+        self.next_seq = 0
+        self.lost = 0 # shots overwritten before follow() got to them
+
+    @property
+    def head(self):
+        """ sequence number of the next shot the producer will publish """
+        return int(self.header[0])
+
+    def valid(self, seq):
+        return self.slot_seq[seq % self.slots] == seq
+
+    def read(self, seq, copy=False):
+        """ Data for shot seq, or None if it hasn't been published yet or has already been overwritten """
+        slot = seq % self.slots
+        if self.slot_seq[slot] != seq:
+            return None
+        view = self.data[slot, :self.slot_len[slot]]
+        if copy:
+            view = view.copy()
+            if not self.valid(seq):
+                return None
+        return view
+
+    def follow(self, poll_interval=1e-3, timeout=None, copy=False):
+        """ Generator yielding (seq, data) for each new shot in order, skipping any that were overwritten before
+        they could be read. Stops after timeout seconds without a new shot (never, if timeout is None).
+        """
+        last = time.monotonic()
+        while True:
+            head = self.head
+            if self.next_seq < head - self.slots:
+                self.lost += head - self.slots - self.next_seq
+                self.next_seq = head - self.slots
+            if self.next_seq < head:
+                data = self.read(self.next_seq, copy)
+                if data is None:
+                    self.lost += 1
+                else:
+                    yield self.next_seq, data
+                self.next_seq += 1
+                last = time.monotonic()
+            elif timeout is not None and time.monotonic() - last > timeout:
+                return
+            else:
+                time.sleep(poll_interval)
+
+    def close(self):
+        del self.header, self.slot_seq, self.slot_len, self.data
+        self.shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _analysis_worker(name, n_shots):
+    with ShotRingReader(name) as r:
+        for seq, data in r.follow(timeout=1):
+            peak = np.abs(np.fft.fft(data)).argmax()
+            if not r.valid(seq): # producer lapped us while we were processing this shot
+                r.lost += 1
+                continue
+            if seq % 100 == 0:
+                print("shot {:d}: spectral peak at bin {:d}".format(seq, peak))
+            if seq == n_shots - 1:
+                break
+        print("analysis worker done, {:d} shots lost".format(r.lost))
+
+def test_ShotRing():
+    import multiprocessing as mp
+    samples, n_shots = 2110, 500
+    t = np.arange(samples)
+    with ShotRing(slots=128, slot_samples=samples) as ring:
+        worker = mp.Process(target=_analysis_worker, args=(ring.name, n_shots))
+        worker.start()
+        for k in range(n_shots):
+            data = np.exp(2j * np.pi * (k % 50) * t / samples).astype(np.complex64) # Experiment.run() in a real scan
+            ring.publish(data)
+            time.sleep(1e-4)
+        worker.join()
+        assert worker.exitcode == 0
+
+if __name__ == "__main__":
+    test_ShotRing()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+#
+# Soak benchmark: drives many Experiment.run() cycles against the dummy server (or a real one), and tracks
+# per-cycle latency, resident memory, open file descriptors and, optionally, Python allocations (tracemalloc)
+# over windows of cycles. The first window is treated as warm-up and later windows are compared with the second,
+# so that latency creep or resource leaks fail the run instead of surfacing during overnight scans.
+#
+# Example: python soak.py --cycles 100000 --window 5000 --trace
+
+import argparse, os, sys, time, tracemalloc
+import numpy as np
+
+from experiment import Experiment
+import dummy_server
+
+def rss_bytes():
+    """ resident set size of this process; None where /proc isn't available """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+def open_fds():
+    """ number of open file descriptors; None where /proc isn't available """
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+def default_experiment():
+    """ a short sequence with TX and gradient data, so every run compiles and uploads a full packet """
+    exp = Experiment(samples=1000)
+    t = np.arange(0, 100, exp.tx_t)
+    exp.add_tx(np.sinc((t - 50) / 10).astype(np.complex64))
+    g = np.linspace(-0.5, 0.5, 200)
+    exp.add_grad(g, -g, 0 * g)
+    return exp
+
+def soak(cycles, window=1000, address=None, make_experiment=default_experiment, trace=False, top=5, log=print):
+    """ Run make_experiment().run(address) cycles times.
+
+    address: (host, port) of the server; None starts a DummyServer in a child process for the duration of the soak
+    trace: track allocations with tracemalloc (slows every cycle down)
+    top: number of allocation hot spots reported per window, compared with the second window
+    log: called with a one-line summary of every window (None: silent)
+
+    Returns a list of per-window statistics dicts: cycle, p50/p95/p99 latency (s), rss and fds at the end of
+    the window, and with trace, the top allocation growths as tracemalloc StatisticDiffs.
+    """
+    srv = None
+    if address is None:
+        srv, port = dummy_server.start_process()
+        address = ('localhost', port)
+    if trace:
+        tracemalloc.start(10)
+    windows = []
+    baseline = None
+    lat = np.empty(window)
+    try:
+        for c in range(cycles):
+            t = time.perf_counter()
+            make_experiment().run(address)
+            lat[c % window] = time.perf_counter() - t
+            if (c + 1) % window and c + 1 < cycles:
+                continue
+
+            n = c % window + 1
+            p50, p95, p99 = np.percentile(lat[:n], [50, 95, 99])
+            w = {'cycle': c + 1, 'p50': p50, 'p95': p95, 'p99': p99, 'rss': rss_bytes(), 'fds': open_fds()}
+            if trace:
+                snap = tracemalloc.take_snapshot().filter_traces(
+                    [tracemalloc.Filter(False, tracemalloc.__file__)])
+                if len(windows) == 1:
+                    baseline = snap
+                elif baseline is not None:
+                    w['alloc_growth'] = snap.compare_to(baseline, 'lineno')[:top]
+            windows.append(w)
+            if log is not None:
+                log("{:8d} cycles: latency p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms; RSS {} MiB; {} fds".format(
+                    w['cycle'], p50 * 1e3, p95 * 1e3, p99 * 1e3,
+                    'n/a' if w['rss'] is None else '{:.1f}'.format(w['rss'] / 2**20), w['fds']))
+                for d in w.get('alloc_growth', ()):
+                    log("    {:+.1f} KiB in {:d} blocks: {}".format(d.size_diff / 1024, d.count_diff, d.traceback))
+    finally:
+        if trace:
+            tracemalloc.stop()
+        if srv is not None:
+            srv.terminate()
+            srv.join()
+    return windows
+
+def check(windows, max_latency_ratio=1.5, max_rss_growth=32 * 2**20, max_fd_growth=0):
+    """ Compare the last window with the second (the first is warm-up); returns a list of failure descriptions,
+    empty if the soak passed.
+
+    max_latency_ratio: limit on the growth of the median and 99th percentile latencies
+    max_rss_growth: limit on resident memory growth, bytes
+    max_fd_growth: limit on the number of additional open file descriptors
+    """
+    if len(windows) < 3:
+        return ["too few windows to check for drift ({:d}); run more cycles or use a shorter window".format(
+            len(windows))]
+    ref, last = windows[1], windows[-1]
+    failures = []
+    for p in ('p50', 'p99'):
+        if last[p] > max_latency_ratio * ref[p]:
+            failures.append("{:s} latency drifted from {:.2f} ms to {:.2f} ms".format(p, ref[p] * 1e3, last[p] * 1e3))
+    if ref['rss'] is not None and last['rss'] - ref['rss'] > max_rss_growth:
+        failures.append("RSS grew by {:.1f} MiB".format((last['rss'] - ref['rss']) / 2**20))
+    if ref['fds'] is not None and last['fds'] - ref['fds'] > max_fd_growth:
+        failures.append("{:d} file descriptors leaked".format(last['fds'] - ref['fds']))
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Soak test of Experiment.run() for latency drift and leaks")
+    parser.add_argument('--cycles', type=int, default=100000)
+    parser.add_argument('--window', type=int, default=5000, help="cycles per statistics window")
+    parser.add_argument('--server', default=None, metavar='HOST:PORT',
+                        help="server to run against (default: a local dummy server)")
+    parser.add_argument('--trace', action='store_true', help="report allocation hot spots with tracemalloc")
+    parser.add_argument('--max-latency-ratio', type=float, default=1.5)
+    parser.add_argument('--max-rss-growth-mib', type=float, default=32)
+    parser.add_argument('--max-fd-growth', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    address = None
+    if args.server is not None:
+        host, port = args.server.rsplit(':', 1)
+        address = (host, int(port))
+    windows = soak(args.cycles, args.window, address, trace=args.trace)
+    failures = check(windows, args.max_latency_ratio, args.max_rss_growth_mib * 2**20, args.max_fd_growth)
+    for f in failures:
+        print("FAIL:", f)
+    if not failures:
+        print("PASS")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
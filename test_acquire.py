@@ -81,12 +81,7 @@ class AcquireTest(unittest.TestCase):
         })
 
         reply = send_packet(packet, self.s)
-        for sti in ('infos','warnings','errors'):
-            try:
-                for k in reply[5][sti]:
-                    print(k)
-            except KeyError:
-                pass
+        Reporter('infos')(Reply(reply))
 
         acquired_data_raw = reply[4]['acq']
         data = np.frombuffer(acquired_data_raw, np.complex64)
@@ -175,12 +170,7 @@ class AcquireTest(unittest.TestCase):
                 data = np.frombuffer(acquired_data_raw, np.complex64)
                 # time.sleep(0.1)
 
-                for sti in ('infos','warnings','errors'):
-                    try:
-                        for k in reply[5][sti]:
-                            print(k)
-                    except KeyError:
-                        pass                    
+                Reporter('infos')(Reply(reply))
                 
         if False:
             # ramp the x gradient voltage offset
@@ -196,12 +186,7 @@ class AcquireTest(unittest.TestCase):
                 data = np.frombuffer(acquired_data_raw, np.complex64)
                 # time.sleep(0.1)
 
-                for sti in ('infos','warnings','errors'):
-                    try:
-                        for k in reply[5][sti]:
-                            print(k)
-                    except KeyError:
-                        pass                    
+                Reporter('infos')(Reply(reply))
                 
             # for k in range(3):
             #     reply = send_packet(packet, self.s)
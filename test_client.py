@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+#
+# Client-side tests; unlike test_server.py and test_acquire.py, these don't need a MaRCoS server to be running.
+
+import io, os, select, socket, subprocess, sys, tempfile, threading, time, unittest
+import numpy as np
+
+import server_comms as sc
+from dummy_server import DummyServer
+
+# Import-time budgets in seconds, for a fresh interpreter (best of several tries)
+import_budgets = {'experiment': 0.5, 'server_comms': 0.15}
+import_tries = 3
+
+def import_time(module):
+    """ Time taken by 'import module' in a fresh interpreter, and the heavy modules it pulled in """
+    code = ("import sys, time; t = time.perf_counter(); import {:s}; t = time.perf_counter() - t; "
+            "print(t, *[m for m in ('matplotlib', 'scipy', 'pdb') if m in sys.modules])").format(module)
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+    return float(out[0]), out[1:]
+
+class ImportTest(unittest.TestCase):
+
+    def test_import_time(self):
+        for module, budget in import_budgets.items():
+            with self.subTest(module=module):
+                times, heavy = zip(*(import_time(module) for k in range(import_tries)))
+                self.assertEqual(heavy[0], [], "{:s} imports plotting/debugging modules at load".format(module))
+                self.assertLess(min(times), budget,
+                                "import {:s} took {:.3f}s, budget {:.3f}s".format(module, min(times), budget))
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for srv, s in self.servers:
+            s.close()
+            srv.stop()
+
+    def connect(self, compression=True):
+        srv = DummyServer(compression=compression).start()
+        s = socket.create_connection(('localhost', srv.port))
+        self.servers.append((srv, s))
+        return srv, s
+
+    def test_rle(self):
+        for data in (b'', b'\0' * 4096, np.arange(1000, dtype='<u4').tobytes(), b'abcd' * 3 + b'efgh' + b'abcd'):
+            self.assertEqual(sc.rle_decode(sc.rle_encode(data)), data)
+
+    def test_round_trip(self):
+        srv, s = self.connect()
+        comp = sc.Compressor()
+        self.assertEqual(sc.negotiate_compression(s, comp), sc.compression_methods)
+
+        grad = bytearray(4 * sc.grad_bram_samples)
+        grad[:16] = b'\x10\x00\x10\x00' * 4
+        tx = b"0123456789abcdef" * 4096
+        n0 = srv.bytes_received
+        reply = sc.send_packet(sc.construct_packet({'grad_mem_x': grad, 'raw_tx_data': tx, 'tx_size': 5},
+                                                   compressor=comp), s)
+        self.assertEqual(reply[4], {'grad_mem_x': 0, 'raw_tx_data': 0, 'tx_size': 0})
+        self.assertEqual(srv.requests[-1], {'grad_mem_x': grad, 'raw_tx_data': tx, 'tx_size': 5})
+        self.assertLess(srv.bytes_received - n0, 1000)
+        self.assertEqual(comp.bytes_in, len(grad) + len(tx))
+
+    def test_incompressible(self):
+        srv, s = self.connect()
+        comp = sc.Compressor()
+        sc.negotiate_compression(s, comp)
+        noise = np.random.default_rng(0).bytes(4 * sc.tx_bram_samples)
+        packet = sc.construct_packet({'raw_tx_data': noise}, compressor=comp)
+        self.assertIs(type(packet[4]['raw_tx_data']), bytes)
+        self.assertIsNone(comp.stats['raw_tx_data']['method'])
+        sc.send_packet(packet, s)
+        self.assertEqual(srv.requests[-1]['raw_tx_data'], noise)
+
+    def test_calibrate_link(self):
+        srv, s = self.connect()
+        comp = sc.Compressor()
+        sc.negotiate_compression(s, comp)
+        MBps = sc.calibrate_link(s, comp)
+        self.assertEqual(comp.link_MBps, MBps)
+        self.assertGreater(MBps, 0)
+        self.assertEqual(srv.requests[-1]['raw_tx_data'], bytes(4 * sc.tx_bram_samples)) # sent uncompressed
+
+        # Compression only pays off if the link is slow enough
+        tx = b"0123456789abcdef" * 4096
+        for link_MBps, compressed in ((1e9, False), (1e-3, True)):
+            comp = sc.Compressor(link_MBps=link_MBps)
+            sc.negotiate_compression(s, comp)
+            field = sc.construct_packet({'raw_tx_data': tx}, compressor=comp)[4]['raw_tx_data']
+            self.assertEqual(type(field) is not bytes, compressed)
+
+    def test_experiment(self):
+        from experiment import Experiment
+        srv = DummyServer().start()
+        comp = sc.Compressor()
+        n0 = srv.bytes_received
+        for k in range(2): # the compressor is shared, and only negotiated once
+            exp = Experiment(samples=100, compressor=comp)
+            exp.add_tx(np.zeros(sc.tx_bram_samples, np.complex64))
+            exp.add_grad(*np.zeros((3, 1000)))
+            exp.run(('localhost', srv.port))
+        srv.stop()
+        self.assertEqual(comp.methods, sc.compression_methods)
+        self.assertEqual(sum('compression' in r for r in srv.requests), 1)
+        self.assertEqual(srv.requests[-1]['raw_tx_data'], exp.tx_bytes)
+        self.assertEqual(srv.requests[-1]['grad_mem_x'], exp.grad_x_bytes)
+        self.assertLess(srv.bytes_received - n0, len(exp.tx_bytes))
+
+    def test_not_supported(self):
+        srv, s = self.connect(compression=False)
+        comp = sc.Compressor()
+        self.assertEqual(sc.negotiate_compression(s, comp), ())
+        tx = bytes(4 * sc.tx_bram_samples)
+        self.assertIs(sc.construct_packet({'raw_tx_data': tx}, compressor=comp)[4]['raw_tx_data'], tx)
+
+class AcquireChunksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.srv = DummyServer().start()
+        self.conn = sc.Connection(('localhost', self.srv.port))
+
+    def tearDown(self):
+        self.conn.close()
+        self.srv.stop()
+
+    def test_stitched(self):
+        samples = 5 * sc.acq_max_samples + 123
+        data = sc.acquire(self.conn, samples, data={'lo_freq': 0x7000000})
+        np.testing.assert_array_equal(data, np.arange(samples).astype(np.complex64))
+        self.assertEqual(len(self.srv.requests), 6)
+        self.assertEqual(self.srv.requests[0], {'lo_freq': 0x7000000, 'acq': sc.acq_max_samples})
+        self.assertEqual(self.srv.requests[-1], {'acq': 123})
+        self.assertEqual(self.conn.pending, 0)
+
+    def test_chunks(self):
+        sizes = [c.size for c in sc.acquire_chunks(self.conn, 2500, chunk=1000, depth=2)]
+        self.assertEqual(sizes, [1000, 1000, 500])
+
+    def test_failed_chunk(self):
+        with self.assertRaises(RuntimeError):
+            sc.acquire(self.conn, 3 * sc.acq_max_samples + 3, chunk=sc.acq_max_samples + 1)
+        self.assertEqual(sc.acquire(self.conn, 10).size, 10)
+        self.assertEqual(self.conn.pending, 0)
+
+class StopTest(unittest.TestCase):
+
+    acq_rate = 1e4 # samples per second: an acq of 10000 samples takes 1 s
+
+    def setUp(self):
+        self.srv = DummyServer(acq_rate=self.acq_rate).start()
+        self.address = ('localhost', self.srv.port)
+        self.conn = sc.Connection(self.address)
+
+    def tearDown(self):
+        self.conn.close()
+        self.srv.stop()
+
+    def test_timeout(self):
+        with self.assertRaises(TimeoutError):
+            self.conn.transact(sc.construct_packet({'acq': 10000}), timeout=0.1)
+        # The late reply is discarded, so the next request gets its own reply
+        self.assertEqual(self.conn.transact(sc.construct_packet({'tx_size': 3}))[4], {'tx_size': 0})
+        self.assertEqual(self.conn.pending, 0)
+
+    def test_send_packet_timeout(self):
+        with socket.create_connection(self.address) as s:
+            with self.assertRaises(TimeoutError):
+                sc.send_packet(sc.construct_packet({'acq': 10000}), s, timeout=0.1)
+            self.assertIsNone(s.gettimeout()) # the socket's own timeout is restored
+        # Through a Connection, the late reply is discarded and the next request gets its own
+        with self.assertRaises(TimeoutError):
+            sc.send_packet(sc.construct_packet({'acq': 10000}), self.conn, timeout=0.1)
+        self.assertEqual(sc.send_packet(sc.construct_packet({'tx_size': 3}), self.conn)[4], {'tx_size': 0})
+
+    def test_cancel(self):
+        threading.Timer(0.1, self.conn.cancel).start()
+        t = time.monotonic()
+        with self.assertRaises(sc.Cancelled):
+            sc.acquire(self.conn, 30000)
+        # Cancelled well before the acquisition would have finished
+        self.assertLess(time.monotonic() - t, 0.5 * 30000 / self.acq_rate)
+
+    def test_cancel_scope(self):
+        tx_size = sc.construct_packet({'tx_size': 3})
+        # Nothing in flight: nothing to cancel
+        self.conn.cancel()
+        self.assertEqual(self.conn.transact(tx_size)[4], {'tx_size': 0})
+        # A reply that has already arrived is returned
+        self.conn.send(tx_size)
+        select.select([self.conn.socket], [], [], 1)
+        self.conn.cancel()
+        self.assertEqual(self.conn.recv()[4], {'tx_size': 0})
+        # A request still in flight is cancelled, but later ones aren't
+        self.conn.send(sc.construct_packet({'acq': 1000}))
+        self.conn.cancel()
+        with self.assertRaises(sc.Cancelled):
+            self.conn.recv()
+        self.assertEqual(self.conn.transact(tx_size)[4], {'tx_size': 0})
+        self.assertEqual(self.conn.pending, 0)
+
+    def test_emergency_stop_cancel(self):
+        with sc.EmergencyStop(self.address) as es:
+            timer = threading.Timer(0.2, es.stop, kwargs={'cancel': (self.conn,)})
+            timer.start()
+            # The aborted reply usually arrives before the acknowledgement; otherwise the request is cancelled
+            try:
+                reply = self.conn.transact(sc.construct_packet({'acq': 10000}))
+                self.assertIn('aborted', reply[5]['errors'][0])
+            except sc.Cancelled:
+                pass
+            timer.join()
+        self.assertEqual(self.conn.transact(sc.construct_packet({'tx_size': 3}))[4], {'tx_size': 0})
+        self.assertEqual(self.conn.pending, 0)
+
+    def test_emergency_stop(self):
+        with sc.EmergencyStop(self.address) as es:
+            timer = threading.Timer(0.2, es.stop)
+            timer.start()
+            t = time.monotonic()
+            reply = self.conn.transact(sc.construct_packet({'acq': 10000}))
+            t = time.monotonic() - t
+            self.assertEqual(len(reply[4]['acq']) // 8, self.srv.acq_count)
+            self.assertLess(self.srv.acq_count, 10000)
+            self.assertIn('aborted', reply[5]['errors'][0])
+            timer.join()
+            # The stop doesn't wait behind the acquisition, which ends early
+            self.assertEqual(len(es.latencies), 1)
+            self.assertLess(es.latencies[0], t)
+            self.assertLess(t, 10000 / self.acq_rate)
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.tmp.name, 'traffic.mpk')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def session(self, conn):
+        comp = sc.Compressor()
+        sc.negotiate_compression(conn, comp)
+        reply = sc.send_packet(sc.construct_packet({'raw_tx_data': bytes(4 * sc.tx_bram_samples), 'tx_size': 4},
+                                                   compressor=comp), conn)
+        return reply, sc.acquire(conn, 40000, chunk=10000)
+
+    def test_record_replay(self):
+        acq_time = 40000 / 1e5 # s, for the 40000 samples of the session
+        srv = DummyServer(acq_rate=1e5).start()
+        with sc.Connection(('localhost', srv.port), record=self.log) as conn:
+            recorded = self.session(conn)
+        srv.stop()
+
+        times = {}
+        for timing in (False, True):
+            with sc.ReplayConnection(self.log, timing=timing) as conn:
+                t = time.monotonic()
+                replayed = self.session(conn)
+                times[timing] = time.monotonic() - t
+                self.assertEqual(conn.mismatches, 0)
+            self.assertEqual(replayed[0], recorded[0])
+            np.testing.assert_array_equal(replayed[1], recorded[1])
+        # Timed replay waits out the recorded acquisitions; the untimed one doesn't
+        self.assertGreater(times[True], 0.5 * acq_time)
+        self.assertLess(times[False], times[True])
+
+    def test_experiment(self):
+        from experiment import Experiment
+        srv = DummyServer().start()
+        exp = Experiment(samples=100)
+        exp.add_tx(np.ones(10, np.complex64))
+        exp.add_grad(np.zeros(5), np.zeros(5), np.zeros(5))
+        with sc.Connection(('localhost', srv.port), record=self.log) as conn:
+            data = exp.run(conn)
+        srv.stop()
+        with sc.ReplayConnection(self.log) as conn:
+            np.testing.assert_array_equal(exp.run(conn), data)
+            with self.assertRaises(EOFError):
+                exp.run(conn)
+
+class SoakTest(unittest.TestCase):
+
+    def test_short_soak(self):
+        import soak
+        windows = soak.soak(600, window=150, log=None)
+        self.assertEqual([w['cycle'] for w in windows], [150, 300, 450, 600])
+        # Latency is too noisy to judge over such a short soak; leaks aren't
+        self.assertEqual(soak.check(windows, max_latency_ratio=np.inf), [])
+
+class NetBenchTest(unittest.TestCase):
+
+    def test_sweep(self):
+        import net_bench
+        srv = DummyServer().start()
+        with sc.Connection(('localhost', srv.port)) as conn:
+            results = net_bench.measure(conn, 'acq', [64, 1024, 16384], repeats=5)
+        srv.stop()
+        self.assertEqual([r['bytes'] > 8 * r['size'] for r in results], [True] * 3)
+        overhead, MBps = net_bench.fit(results)
+        self.assertGreaterEqual(overhead, 0)
+        self.assertGreater(MBps, 0)
+        size, depth = net_bench.recommend(results, 'acq')
+        self.assertLessEqual(size, sc.acq_max_samples)
+        self.assertGreaterEqual(depth, 1)
+
+class ReplyTest(unittest.TestCase):
+
+    def test_reply(self):
+        srv = DummyServer().start()
+        with sc.Connection(('localhost', srv.port)) as conn:
+            stats = sc.ReplyStats()
+            ok = sc.parse_reply(conn.transact(sc.construct_packet({'acq': 1000, 'tx_size': 10})), stats)
+            bad = sc.parse_reply(conn.transact(sc.construct_packet(
+                {'raw_tx_data': bytes(4 * sc.tx_bram_samples + 4), 'foo': 1, 'tx_div': 3})), stats)
+        srv.stop()
+
+        self.assertTrue(ok.ok)
+        self.assertEqual(ok.code('tx_size'), 0)
+        self.assertIsNone(ok.code('acq'))
+        self.assertEqual(len(ok['acq']), 8000)
+        self.assertFalse(bad.ok)
+        self.assertEqual(sorted(bad.failed), ['UNKNOWN1', 'raw_tx_data'])
+        self.assertEqual(bad.errors, ['too much raw TX data', 'not all client commands were understood'])
+        self.assertEqual((stats.replies, stats.errors, stats.infos), (2, 2, 0))
+        self.assertEqual(stats.failed['raw_tx_data'], 1)
+
+        out = io.StringIO()
+        sc.Reporter('infos', data=True, stream=out)(ok)
+        self.assertEqual(out.getvalue(), "results: {acq: <8000 bytes>, tx_size: 0}\n")
+        out = io.StringIO()
+        sc.Reporter('errors', stream=out)(bad)
+        self.assertEqual(out.getvalue().splitlines()[0], "error: too much raw TX data")
+
+    def test_experiment(self):
+        from experiment import Experiment
+        srv = DummyServer().start()
+        exp = Experiment(samples=100)
+        exp.add_tx(np.ones(10, np.complex64))
+        exp.add_grad(np.zeros(5), np.zeros(5), np.zeros(5))
+        exp.run(('localhost', srv.port))
+        exp.samples = sc.acq_max_samples + 1
+        with self.assertRaises(RuntimeError):
+            exp.run(('localhost', srv.port))
+        srv.stop()
+        self.assertEqual(exp.reply.failed, ['acq'])
+        self.assertEqual((exp.reply_stats.replies, exp.reply_stats.errors), (2, 1))
+
+class ReconstructionTest(unittest.TestCase):
+
+    def setUp(self):
+        # 2D square phantom and its centred k-space
+        self.phantom = np.zeros((32, 48), np.complex64)
+        self.phantom[8:24, 12:36] = 1
+        self.kspace = np.fft.fftshift(np.fft.fftn(np.fft.ifftshift(self.phantom))).astype(np.complex64)
+
+    def reference(self, kspace):
+        return np.fft.fftshift(np.fft.ifftn(np.fft.ifftshift(kspace)))
+
+    def test_plan(self):
+        import reconstruction
+        rng = np.random.default_rng(0)
+        for shape in ((5, 7), (32, 48), (3, 4, 5)):
+            k = (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(np.complex64)
+            img = reconstruction.ReconPlan(shape).execute(k)
+            self.assertEqual(img.dtype, np.complex64)
+            np.testing.assert_allclose(img, self.reference(k), rtol=0, atol=1e-6)
+
+    def test_full_scan(self):
+        from reconstruction import Reconstructor
+        rec = Reconstructor(self.phantom.shape, ro_offset=3, preview_every=8)
+        for pe in np.argsort(np.abs(np.arange(32) - 16), kind='stable'): # centric order
+            rec.add_line(pe, np.concatenate([np.zeros(3, np.complex64), self.kspace[pe]]))
+        img = rec.finish()
+        np.testing.assert_allclose(img, self.phantom, rtol=0, atol=1e-5)
+        np.testing.assert_allclose(rec.preview, np.abs(img))
+        self.assertEqual(rec.lines_in_preview, 32)
+
+    def test_partial(self):
+        from reconstruction import Reconstructor
+        rec = Reconstructor(self.phantom.shape, preview_every=4)
+        for pe in range(12, 16):
+            rec.add_line(pe, self.kspace[pe])
+        rec._pending.result() # the background preview of the first 4 lines
+        zero_filled = np.zeros_like(self.kspace)
+        zero_filled[12:16] = self.kspace[12:16]
+        self.assertEqual(rec.lines_in_preview, 4)
+        np.testing.assert_allclose(rec.preview, np.abs(self.reference(zero_filled)), rtol=0, atol=1e-6)
+        np.testing.assert_allclose(rec.reconstruct(), self.reference(zero_filled), rtol=0, atol=1e-6)
+        rec.finish()
+
+    def test_plan_reuse(self):
+        from reconstruction import Reconstructor
+        recs = [Reconstructor(self.phantom.shape) for k in range(2)]
+        self.assertIs(recs[0].plan, recs[1].plan)
+        self.assertIsNot(Reconstructor((16, 48)).plan, recs[0].plan)
+        # Both reconstruct correctly through the shared plan, including after each other
+        recs[1].add_line(5, self.kspace[5])
+        for pe in range(32):
+            recs[0].add_line(pe, self.kspace[pe])
+        np.testing.assert_allclose(recs[0].finish(), self.phantom, rtol=0, atol=1e-5)
+        zero_filled = np.zeros_like(self.kspace)
+        zero_filled[5] = self.kspace[5]
+        np.testing.assert_allclose(recs[1].finish(), self.reference(zero_filled), rtol=0, atol=1e-6)
+
+class AcqStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'scan')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        from acq_store import AcqWriter, AcqReader
+        rng = np.random.default_rng(0)
+        shots = [(rng.standard_normal(n) + 1j * rng.standard_normal(n)).astype(np.complex64) for n in (100, 60, 100)]
+        status = [{'infos': ['a', 'b'], 'errors': ['c']},
+                  sc.Reply([sc.reply_pkt, 1, 0, sc.version_full, {}, {'warnings': ['w']}]),
+                  None]
+        with AcqWriter(self.path, 100, 10, param_names=('pe_idx', 'lo_freq')) as w:
+            r = AcqReader(self.path) # opened before anything was written
+            self.assertEqual(len(r), 0)
+            for k, (data, st) in enumerate(zip(shots, status)):
+                params = {'pe_idx': k} if k == 1 else {'pe_idx': k, 'lo_freq': 5.0}
+                self.assertEqual(w.append(data, params, st, timestamp=1000 + k), k)
+                # The reader sees each shot as soon as it has been appended
+                self.assertEqual(len(r), k + 1)
+                np.testing.assert_array_equal(r.shot(k), data)
+
+        r = AcqReader(self.path)
+        self.assertEqual(len(r), 3)
+        self.assertEqual([r.shot(k).size for k in range(3)], [100, 60, 100])
+        self.assertEqual(r.shots().shape, (3, 100))
+        np.testing.assert_array_equal(r.shots(1, 2)[0, :60], shots[1])
+        rec = r.records()
+        self.assertEqual(rec['shot'].tolist(), [0, 1, 2])
+        self.assertEqual(rec['timestamp'].tolist(), [1000, 1001, 1002])
+        self.assertEqual(rec['length'].tolist(), [100, 60, 100])
+        self.assertEqual(rec['infos'].tolist(), [2, 0, 0])
+        self.assertEqual(rec['warnings'].tolist(), [0, 1, 0])
+        self.assertEqual(rec['errors'].tolist(), [1, 0, 0])
+        self.assertEqual(r.param('pe_idx').tolist(), [0, 1, 2])
+        lo = r.param('lo_freq')
+        self.assertEqual(lo[[0, 2]].tolist(), [5.0, 5.0])
+        self.assertTrue(np.isnan(lo[1])) # missing parameter
+        with self.assertRaises(AssertionError):
+            r.shot(3)
+
+    def test_full(self):
+        from acq_store import AcqWriter
+        with AcqWriter(self.path, 10, 2) as w:
+            w.append(np.zeros(10, np.complex64))
+            w.append(np.zeros(10, np.complex64))
+            with self.assertRaises(AssertionError):
+                w.append(np.zeros(10, np.complex64))
+            with self.assertRaises(AssertionError):
+                AcqWriter(self.path + '2', 10, 2).append(np.zeros(11, np.complex64)) # too long
+
+class ShotRingTest(unittest.TestCase):
+
+    def setUp(self):
+        from shm_ring import ShotRing, ShotRingReader
+        self.ring = ShotRing(slots=4, slot_samples=8)
+        self.reader = ShotRingReader(self.ring.name)
+
+    def tearDown(self):
+        self.reader.close()
+        self.ring.close()
+
+    def shot(self, seq):
+        return np.full(8 - seq % 3, seq, np.complex64) # distinct data and lengths
+
+    def test_overrun(self):
+        ring, r = self.ring, self.reader
+        for seq in range(3):
+            self.assertEqual(ring.publish(self.shot(seq)), seq)
+        self.assertEqual(r.head, 3)
+        for seq in range(3):
+            np.testing.assert_array_equal(r.read(seq), self.shot(seq))
+        self.assertIsNone(r.read(3)) # not published yet
+
+        view, kept = r.read(0), r.read(0, copy=True)
+        for seq in range(3, 6): # shots 4 and 5 overwrite the slots of 0 and 1
+            ring.publish(self.shot(seq))
+        self.assertFalse(r.valid(0))
+        self.assertFalse(r.valid(1))
+        self.assertTrue(all(r.valid(seq) for seq in range(2, 6)))
+        self.assertIsNone(r.read(0))
+        self.assertIsNone(r.read(0, copy=True))
+        np.testing.assert_array_equal(view[:6], self.shot(4)[:6]) # the view was overwritten; the copy wasn't
+        np.testing.assert_array_equal(kept, self.shot(0))
+
+        # A slot being written is invalid until publish() completes
+        ring.slot_seq[5 % 4] = -1
+        self.assertFalse(r.valid(5))
+        self.assertIsNone(r.read(5, copy=True))
+        ring.slot_seq[5 % 4] = 5
+
+    def test_follow_lost(self):
+        ring, r = self.ring, self.reader
+        for seq in range(10):
+            ring.publish(self.shot(seq))
+        # Shots 0-5 were overwritten before the reader got to them
+        got = [(seq, data.copy()) for seq, data in r.follow(timeout=0)]
+        self.assertEqual([seq for seq, _ in got], [6, 7, 8, 9])
+        for seq, data in got:
+            np.testing.assert_array_equal(data, self.shot(seq))
+        self.assertEqual(r.lost, 6)
+
+        # Nothing more is lost if the reader keeps up, except shots torn by the producer
+        ring.publish(self.shot(10))
+        ring.publish(self.shot(11))
+        ring.slot_seq[11 % 4] = -1
+        self.assertEqual([seq for seq, _ in r.follow(timeout=0)], [10])
+        self.assertEqual(r.lost, 7)
+        self.assertEqual(r.next_seq, 12)
+
+    def test_latest_shot(self):
+        from live_view import latest_shot
+        ring, r = self.ring, self.reader
+        self.assertIsNone(latest_shot(r))
+        ring.publish(self.shot(0))
+        seq, data, skipped = latest_shot(r)
+        self.assertEqual((seq, skipped), (0, 0))
+        np.testing.assert_array_equal(data, self.shot(0))
+        self.assertIsNone(latest_shot(r, 0)) # nothing new since shot 0
+
+        # Only the newest shot is shown; the ones in between are skipped, including those already overwritten
+        for seq in range(1, 7):
+            ring.publish(self.shot(seq))
+        seq, data, skipped = latest_shot(r, 0)
+        self.assertEqual((seq, skipped), (6, 5))
+        np.testing.assert_array_equal(data, self.shot(6))
+        ring.publish(self.shot(7))
+        data[:] = 0 # a copy, not a view into the ring
+        np.testing.assert_array_equal(r.read(6), self.shot(6))
+
+        # A shot being overwritten is passed over for the previous one
+        ring.slot_seq[7 % 4] = -1
+        self.assertIsNone(latest_shot(r, 6))
+        self.assertEqual(latest_shot(r, 5)[:1], (6,))
+
+if __name__ == "__main__":
+    unittest.main()
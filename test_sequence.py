@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+#
+# Tests of sequence compilation and offline simulation; these don't need a MaRCoS server to be running.
+
+import os, shutil, tempfile, unittest, warnings
+import numpy as np
+
+from ocra_lib.assembler import Assembler, assemble_batch
+import sequence_sim as ss
+import compaction
+import bram_planner
+import grad_conditioning as gc
+import waveforms as wf
+from experiment import Experiment, quantize
+
+class SimulatorTest(unittest.TestCase):
+
+    def test_grad_echo(self):
+        with open("ocra_lib/grad_echo.txt") as f:
+            table, lengths, _ = assemble_batch([f.read()])
+        tl = ss.simulate(table[0, :lengths[0]].tobytes())
+        cyc = 1 / 7e-3 # cycles per us as encoded by the assembler
+        np.testing.assert_array_equal(tl.duration, np.floor(np.array([210, 1900, 200, 200]) * cyc))
+        np.testing.assert_array_equal(tl.tx_offset, [0, 0, 2001, 2001])
+        self.assertEqual(tl.cycles, tl.duration.sum())
+
+        # RX is on (RX_PULSE low) during the gradient and second TX pulse
+        start, stop = tl.rx_windows()
+        np.testing.assert_array_equal(start, [tl.duration[0]])
+        np.testing.assert_array_equal(stop, [tl.duration[:3].sum()])
+        rx_t = 0.5
+        self.assertEqual(tl.rx_samples(rx_t), int((stop[0] - start[0]) // (2 * rx_t * tl.clk_freq_MHz)))
+        self.assertEqual(tl.rx_samples(rx_t, decimation=1), int((stop[0] - start[0]) // (rx_t * tl.clk_freq_MHz)))
+
+        # Within 1% of the hand-tuned size of experiment.test_grad_echo() (about 1 sample per us of RX window),
+        # once the assembler's 7 ns cycles are converted to the FPGA clock
+        exp = Experiment(samples=None)
+        exp.compile()
+        self.assertEqual(exp.samples, 2459)
+        self.assertAlmostEqual(exp.samples, 2110 * cyc / tl.clk_freq_MHz, delta=0.01 * exp.samples)
+
+        self.assertEqual(tl.sample([0, tl.duration_us + 1]).tolist(), [0x13, 0])
+
+    def test_loop(self):
+        prog = [
+            "J 3",
+            "CTR = 0x5",
+            "CMD = TX_GATE",
+            "LD64 2, CTR",
+            "LD64 3, CMD",
+            "PR 3, 10",
+            "DEC 2",
+            "JNZ 2, 0x5",
+            "HALT"]
+        table, lengths, _ = assemble_batch([prog])
+        tl = ss.simulate(table[0, :lengths[0]].tobytes())
+        self.assertEqual(len(tl), 5)
+        self.assertTrue(np.all(tl.active(ss.TX_GATE)))
+        self.assertEqual(tl.windows(tl.active(ss.TX_GATE))[1].tolist(), [tl.cycles])
+
+    def test_auto_samples(self):
+        def program(t): # RX is on (RX_PULSE low) for the whole PR
+            return lambda tx, grad: "J 2\nCMD = TX_GATE\nLD64 3, CMD\nPR 3, {:d}\nHALT".format(t)
+        exp = Experiment(samples=None, instruction_file=program(100))
+        exp.compile()
+        n = exp.samples
+        self.assertEqual(n, exp.simulate().rx_samples(exp.rx_t))
+        self.assertGreater(n, 0)
+        # Recompiling after the program changes re-sizes the acquisition
+        exp.instruction_file = program(200)
+        exp.compile()
+        self.assertTrue(exp.auto_samples)
+        self.assertIn(exp.samples, (2 * n, 2 * n + 1))
+
+class AssembleBatchTest(unittest.TestCase):
+
+    def test_matches_assembler(self):
+        files = ["ocra_lib/grad_echo.txt", "ocra_lib/se_default_vn.txt"]
+        table, lengths, symbols = assemble_batch([open(f).read() for f in files])
+        self.assertEqual(table.dtype, np.uint32)
+        self.assertEqual(table.shape, (2, lengths.max()))
+        with tempfile.TemporaryDirectory() as d: # Assembler writes a hex file next to its input
+            for k, f in enumerate(files):
+                path = shutil.copy(f, d)
+                self.assertEqual(table[k, :lengths[k]].tobytes(), Assembler().assemble(path))
+        self.assertEqual(symbols[0]['CMD12'], 12)
+
+    def test_template(self):
+        template = "J 2 // {not a field}\nCTR = {n:#x}\nLD64 2, CTR\nPR 3, {t}\nDEC 2\nJNZ 2, 0x3\nHALT"
+        params = [{'n': n, 't': t} for n in (1, 5) for t in (10, 20, 30)]
+        table, lengths, symbols = assemble_batch(template, params)
+        self.assertEqual(table.shape, (6, 14))
+        self.assertEqual(symbols, [{'CTR': 1}] * 6)
+        for p, row in zip(params, table):
+            tl = ss.simulate(row.tobytes())
+            self.assertEqual(len(tl), p['n'])
+            self.assertTrue(np.all(tl.duration == np.floor(p['t'] / 7e-3)))
+
+    def test_hex_like_symbols(self):
+        # Variable names that are also valid hex numbers refer to the variable, as for Assembler
+        prog = "J 5\nFACE = 0x5\nA = 0x7\nADD = 0x9\nC1 = TX_GATE\nLD64 2, FACE\nLD64 3, A\nLD64 4, ADD\n" \
+            "LD64 5, C1\nLD64 6, 1F\nJNZ 2, A\nHALT"
+        table, lengths, symbols = assemble_batch([prog])
+        self.assertEqual(symbols[0], {'FACE': 1, 'A': 2, 'ADD': 3, 'C1': 4})
+        _, _, _, arg = ss.decode(table[0, :lengths[0]].tobytes())
+        self.assertEqual(arg[5:11].tolist(), [1, 2, 3, 4, 0x1f, 2])
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "prog.txt")
+            with open(path, "w") as f:
+                f.write(prog)
+            self.assertEqual(table[0, :lengths[0]].tobytes(), Assembler().assemble(path))
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            assemble_batch(["LD64 2, CTR\nHALT"]) # undefined variable
+        with self.assertRaises(ValueError):
+            assemble_batch(["FOO 3"])
+
+class CompactionTest(unittest.TestCase):
+
+    def test_compact_and_replay(self):
+        exp = Experiment()
+        n = 2000
+        t = np.arange(n) * exp.tx_t
+        burst = np.exp(2j * np.pi * np.arange(n) / 50) # period of 50 samples
+        pulse = np.sinc((t - t[n // 2]) / 10)
+        hard = np.ones(n)
+        comp = compaction.compact([pulse, burst, hard, pulse])
+        # Periods are at least 64 samples: the burst is stored as two of its periods, the hard pulse as 80 samples
+        self.assertEqual(comp.size, 2000 + 100 + 80)
+        self.assertEqual(comp.offsets.tolist(), [0, 2000, 2100, 0])
+        self.assertEqual(comp.periods.tolist(), [2000, 100, 80, 2000])
+        self.assertEqual(comp.repeats.tolist(), [1, 20, 25, 1])
+        self.assertFalse(comp.unrolled)
+        for k, seg in enumerate([pulse, burst, hard, pulse]):
+            np.testing.assert_allclose(comp.expand(k), seg, rtol=0, atol=compaction.dac_atol)
+
+        # Replay each segment from a generated loop, and check the simulated output at the real TX sample period
+        for k in range(4):
+            n_vars = int(comp.repeats[k] > 1) # the loop counter
+            var_lines, code_lines = compaction.replay_asm(comp, k, 'TX', cmd_reg=3, ctr_reg=2, ctr_var='CTR',
+                                                          sample_t=exp.tx_t, loop_addr=3 + n_vars)
+            prog = ["J {:d}".format(2 + len(var_lines)), "CMD = TX_GATE | TX_PULSE"] + var_lines + \
+                ["LD64 3, CMD"] + code_lines + ["HALT"]
+            table, lengths, _ = assemble_batch([prog])
+            tl = ss.simulate(table[0, :lengths[0]].tobytes())
+            self.assertEqual(len(tl), comp.repeats[k])
+            self.assertTrue(np.all(tl.tx_offset == comp.offsets[k]))
+            self.assertTrue(np.all(tl.duration == comp.periods[k] * exp.tx_div))
+            self.assertEqual(tl.cycles, n * exp.tx_div)
+
+    def test_experiment_program(self):
+        def program(tx, grad):
+            var_lines, code_lines = compaction.replay_asm(tx, 0, 'TX', cmd_reg=3, ctr_reg=2, ctr_var='CTR',
+                                                          sample_t=exp.tx_t, loop_addr=4)
+            return ["J 3", "CMD = TX_GATE | TX_PULSE"] + var_lines + ["LD64 3, CMD"] + code_lines + ["HALT"]
+
+        exp = Experiment(samples=100, compact=True)
+        exp.add_tx(np.ones(2000, np.complex64))
+        exp.add_grad(*np.zeros((3, 100)))
+        # The default program addresses the unrolled layout
+        with self.assertRaises(ValueError):
+            exp.compile()
+
+        exp.instruction_file = program
+        exp.compile()
+        self.assertEqual(len(exp.tx_bytes), 4 * 80)
+        tl = exp.simulate()
+        self.assertEqual(len(tl), 25)
+        self.assertEqual(tl.cycles, 2000 * exp.tx_div)
+
+class PlannerTest(unittest.TestCase):
+
+    def check_plans(self, runs, sizes, capacity, plans):
+        for keys, p in zip(runs, plans):
+            self.assertTrue(set(keys) <= set(p.offsets))
+            spans = sorted((off, off + sizes[k]) for k, off in p.resident.items())
+            self.assertTrue(all(a[1] <= b[0] for a, b in zip(spans, spans[1:])), "overlapping segments")
+            self.assertLessEqual(spans[-1][1], capacity)
+            self.assertLessEqual(p.upload_size, sum(sizes[k] for k in set(keys)))
+
+    def test_resident_segments(self):
+        sizes = {'exc': 2000, 'refoc': 3000}
+        runs = []
+        for k in range(10):
+            sizes[k] = 1500
+            runs.append(['exc', k, 'refoc'])
+        plans = bram_planner.plan(runs, sizes, 16384)
+        self.check_plans(runs, sizes, 16384, plans)
+        self.assertEqual([p.upload_size for p in plans], [6500] + [1500] * 9)
+        self.assertEqual(len({(p.offsets['exc'], p.offsets['refoc']) for p in plans}), 1)
+
+    def test_random_protocols(self):
+        rng = np.random.default_rng(0)
+        sizes = {k: int(rng.integers(100, 2000)) for k in range(30)}
+        runs = [list(rng.choice(30, size=int(rng.integers(1, 5)), replace=False)) for r in range(200)]
+        plans = bram_planner.plan(runs, sizes, 8192)
+        self.check_plans(runs, sizes, 8192, plans)
+
+        segments = {k: rng.standard_normal(n) for k, n in sizes.items()}
+        for keys, p in zip(runs, plans):
+            img = bram_planner.build_image(p, segments)
+            for k in p.loaded:
+                np.testing.assert_array_equal(img[p.offsets[k]:p.offsets[k] + sizes[k]], segments[k])
+
+    def test_too_large(self):
+        with self.assertRaises(ValueError):
+            bram_planner.plan([['a', 'b']], {'a': 1500, 'b': 1000}, 2048)
+
+class GradConditionerTest(unittest.TestCase):
+
+    def test_resample(self):
+        ramp = np.linspace(0, 0.5, 51) # 0 to 0.5 over 100 us, authored at 2 us
+        segs = [np.vstack([ramp, -ramp, 0 * ramp]), 0.1 * np.ones((3, 7))]
+        c = gc.GradConditioner(dt=10)
+        out = c.condition(segs, [2, None])
+        self.assertEqual([o.shape for o in out], [(3, 10), (3, 7)])
+        np.testing.assert_allclose(out[0][0], ramp[::5][:10], atol=1e-6)
+        np.testing.assert_allclose(out[1], 0.1, atol=1e-6)
+
+    def test_empty(self):
+        c = gc.GradConditioner(dt=10)
+        self.assertEqual(c.condition([]), [])
+        self.assertEqual(c.clipped.tolist(), [0, 0, 0])
+        # An Experiment with a conditioner but no gradient segments compiles like one without
+        exp = Experiment(grad_conditioner=c)
+        exp.add_tx(np.ones(10, np.complex64))
+        exp.compile_grad_data()
+        self.assertEqual(len(exp.grad_x_bytes), 0)
+
+    def test_preemph_gain_clip(self):
+        step = np.zeros((3, 200))
+        step[:, 10:] = 0.5
+        terms = [(0.1, 50), (0.02, 400)]
+        c = gc.GradConditioner(gain=(1, 2, 3), offset=(0, 0.1, 0), preemph=terms, dt=10)
+        out = c.condition([step])[0]
+
+        # Pre-emphasis: overshoot at the step, decaying back to the flat level
+        expected = step[0].copy()
+        for amp, tau in terms:
+            alpha = np.exp(-10 / tau)
+            expected += amp * gc.sig.lfilter([alpha, -alpha], [1, -alpha], step[0])
+        np.testing.assert_allclose(out[0], expected, atol=1e-6)
+        self.assertAlmostEqual(float(out[0, -1]), 0.5, places=3)
+
+        np.testing.assert_allclose(out[1], np.clip(2 * expected + 0.1, -1, 1), atol=1e-6)
+        self.assertTrue(np.all(out[2, 10:] == 1))
+        self.assertEqual(c.clipped.tolist(), [0, int(np.sum(2 * expected + 0.1 > 1)), 190])
+
+class CompileDataTest(unittest.TestCase):
+
+    def test_byte_layout(self):
+        exp = Experiment()
+        exp.add_tx(np.array([0.5 - 0.25j, -1], np.complex64))
+        g = np.array([1, -1, 0.5])
+        exp.add_grad(g, -g, 0 * g)
+        exp.compile_tx_data()
+        exp.compile_grad_data()
+        self.assertEqual(bytes(exp.tx_bytes), np.array([16384, -8192, -32767, 0], '<i2').tobytes())
+        words = [0x00100000 | ((c & 0xffff) << 4) for c in (32767, -32767, 16384)]
+        self.assertEqual(bytes(exp.grad_x_bytes), np.array(words, '<u4').tobytes())
+
+    def test_int16_codes(self):
+        rng = np.random.default_rng(0)
+        tx = (0.9 * np.exp(2j * np.pi * rng.random(100))).astype(np.complex64)
+        grad = rng.uniform(-1, 1, (3, 50)).astype(np.float32)
+        tx_codes, _ = quantize(tx.view(np.float32).reshape(-1, 2))
+        grad_codes, _ = quantize(grad, axis=1)
+
+        exps = [Experiment(), Experiment()]
+        exps[0].add_tx(tx)
+        exps[0].add_grad(*grad)
+        exps[1].add_tx(tx_codes)
+        exps[1].add_grad(*grad_codes)
+        for e in exps:
+            e.compile_tx_data()
+            e.compile_grad_data()
+        self.assertIs(exps[1].tx_segments[0], tx_codes)
+        self.assertEqual(exps[0].tx_bytes, exps[1].tx_bytes)
+        self.assertEqual(exps[0].grad_z_bytes, exps[1].grad_z_bytes)
+
+    def test_saturation(self):
+        exp = Experiment()
+        exp.add_tx(np.array([1.5, 0.5 + 2j]))
+        exp.add_grad(np.array([2., 0]), np.zeros(2), np.array([-1.1, -1.2]))
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            exp.compile_tx_data()
+            exp.compile_grad_data()
+        self.assertEqual(exp.tx_saturated, 2)
+        self.assertEqual(exp.tx_over_magnitude, 2)
+        self.assertEqual(exp.grad_saturated.tolist(), [1, 0, 2])
+        self.assertEqual(exp.tx_codes.tolist(), [[32767, 0], [16384, 32767]])
+
+        # Too large in magnitude, although neither I nor Q clips
+        exp = Experiment()
+        exp.add_tx(np.array([0.8 + 0.8j, 1 + 1j, 0.6 + 0.8j], np.complex64))
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            exp.compile_tx_data()
+        self.assertEqual((exp.tx_over_magnitude, exp.tx_saturated), (2, 0))
+        self.assertEqual(len(w), 1)
+        self.assertIn("2 samples have a magnitude above 1", str(w[0].message))
+
+class WaveformsTest(unittest.TestCase):
+
+    def setUp(self):
+        wf.cache_clear()
+
+    def test_sample_counts(self):
+        tx_t = Experiment().tx_t
+        self.assertEqual(wf.sinc(200, dt=tx_t).shape, (2048,))
+        self.assertEqual(wf.gaussian(100, dt=tx_t).shape, (1024,))
+        self.assertEqual(wf.hard(100, dt=0.1).shape, (1000,))
+        self.assertEqual(wf.phase_modulated(1000, 0.02, dt=tx_t).shape, (10240,))
+        self.assertEqual(wf.trapezoid(200, 30).shape, (3 + 20 + 3,)) # at grad_t = 10 us
+        self.assertEqual(wf.ramp(100, 0, 1).shape, (10,))
+        self.assertEqual(wf.hard(100).dtype, np.complex64)
+        self.assertEqual(wf.trapezoid(200, 30).dtype, np.float32)
+
+    def test_batches(self):
+        self.assertEqual(wf.sinc(200, amp=[0.5, 1]).shape, (2, 2000))
+        self.assertEqual(wf.sinc(200, lobes=[2, 3, 4], amp=[1, 1, 0.5]).shape, (3, 2000))
+        pe = wf.trapezoid(200, 30, amp=np.linspace(-1, 1, 64))
+        self.assertEqual(pe.shape, (64, 26))
+        np.testing.assert_allclose(pe[:, 10], np.linspace(-1, 1, 64), atol=1e-6) # flat top
+        r = wf.ramp(100, [0, 1], [1, 0])
+        np.testing.assert_allclose(r[1], r[0, ::-1], atol=1e-6)
+        # Each row is the waveform for that value on its own
+        np.testing.assert_allclose(wf.hard(10, freq=[0, 0.1])[1], wf.hard(10, freq=0.1))
+
+    def test_read_only_and_cached(self):
+        a = wf.sinc(200, lobes=4, amp=0.5)
+        self.assertFalse(a.flags.writeable)
+        with self.assertRaises(ValueError):
+            a[0] = 1
+        self.assertIs(wf.sinc(200, lobes=4, amp=0.5), a)
+        self.assertIs(wf.trapezoid(100, 20, amp=[0.1, 0.2]), wf.trapezoid(100, 20, amp=np.array([0.1, 0.2])))
+        info = wf.cache_info()
+        self.assertEqual((info['sinc'].hits, info['sinc'].misses), (1, 1))
+        self.assertEqual((info['trapezoid'].hits, info['trapezoid'].misses), (1, 1))
+        self.assertIsNot(wf.sinc(200, lobes=4, amp=0.6), a)
+        wf.cache_clear()
+        self.assertEqual(wf.cache_info()['sinc'].currsize, 0)
+
+    def test_sinc_zero_crossings(self):
+        # 3 lobes over 600 samples: zeros every 100 samples either side of the peak at sample 300
+        w = wf.sinc(600, lobes=3, dt=1, amp=0.8)
+        self.assertAlmostEqual(w[300], 0.8, places=6)
+        np.testing.assert_allclose(w[[0, 100, 200, 400, 500]], 0, atol=1e-6)
+        self.assertTrue(np.all(np.abs(w[101:200]) > 0))
+
+    def test_trapezoid_levels(self):
+        w = wf.trapezoid(100, 30, dt=10, amp=0.8)
+        up = 0.8 * np.array([0.25, 0.5, 0.75]) # ramps stop short of both 0 and the flat top
+        np.testing.assert_allclose(w, np.concatenate([up, 0.8 * np.ones(10), up[::-1]]), atol=1e-6)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+#
+# Parametric RF and gradient waveform library. Waveforms are sampled directly at the TX sample period
+# (Experiment.tx_t) or the gradient update period (server_comms.grad_t), in full-scale DAC units ready for
+# Experiment.add_tx()/add_grad().
+#
+# Results are memoised by their shape parameters in bounded LRU caches and returned as read-only arrays, so sweep
+# loops that ask for the same pulse on every run get the stored array back instead of regenerating it. Copy a
+# result (np.array(w)) before modifying it.
+#
+# Batches: any parameter documented as batchable may be a sequence instead of a scalar; the result then gets a
+# leading batch axis, one row per value (several batchable sequences must have equal lengths). Durations set
+# the number of samples, so they can't be batched.
+
+from functools import lru_cache
+import numpy as np
+
+import server_comms as sc
+
+cache_size = 256 # waveforms kept per shape
+
+def _hashable(x):
+    return tuple(np.ravel(x).tolist()) if np.ndim(x) else float(x)
+
+def _col(x):
+    """ batch parameter as a column, so it broadcasts against the time axis """
+    a = np.asarray(x, float)
+    return a[:, None] if a.ndim else a
+
+def _frozen(a):
+    a.setflags(write=False)
+    return a
+
+def _times(duration, dt):
+    n = int(round(duration / dt))
+    return np.arange(n) * dt
+
+def _modulate(env, t, freq, phase=0):
+    """ complex RF waveform from a real envelope, at a frequency offset from the LO (MHz) """
+    return _frozen((env * np.exp(1j * (2 * np.pi * _col(freq) * t + phase))).astype(np.complex64))
+
+@lru_cache(maxsize=cache_size)
+def _sinc(duration, lobes, dt, amp, freq):
+    t = _times(duration, dt)
+    x = 2 * t / duration - 1 # -1 to 1 across the pulse
+    return _modulate(_col(amp) * np.sinc(_col(lobes) * x), t, freq)
+
+def sinc(duration, lobes=3, dt=0.1, amp=1, freq=0):
+    """ Sinc RF pulse centred in its duration.
+
+    duration: us
+    lobes: zero crossings on each side of the main lobe (batchable)
+    dt: sample period, us (use Experiment.tx_t)
+    amp: peak amplitude, full-scale units (batchable)
+    freq: frequency offset from the LO, MHz (batchable)
+    """
+    return _sinc(float(duration), _hashable(lobes), float(dt), _hashable(amp), _hashable(freq))
+
+@lru_cache(maxsize=cache_size)
+def _gaussian(duration, sd, dt, amp, freq):
+    t = _times(duration, dt)
+    return _modulate(_col(amp) * np.exp(-(t - duration / 2) ** 2 / (2 * _col(sd) ** 2)), t, freq)
+
+def gaussian(duration, sd=None, dt=0.1, amp=1, freq=0):
+    """ Gaussian RF pulse centred in its duration.
+
+    sd: standard deviation, us; defaults to duration / 6 (batchable)
+    Other arguments as for sinc().
+    """
+    sd = duration / 6 if sd is None else sd
+    return _gaussian(float(duration), _hashable(sd), float(dt), _hashable(amp), _hashable(freq))
+
+@lru_cache(maxsize=cache_size)
+def _hard(duration, dt, amp, freq):
+    t = _times(duration, dt)
+    return _modulate(_col(amp) * np.ones_like(t), t, freq)
+
+def hard(duration, dt=0.1, amp=1, freq=0):
+    """ Rectangular (hard) RF pulse; arguments as for sinc() """
+    return _hard(float(duration), float(dt), _hashable(amp), _hashable(freq))
+
+@lru_cache(maxsize=cache_size)
+def _phase_modulated(duration, bandwidth, beta, dt, amp, freq, sweep):
+    t = _times(duration, dt)
+    tau = 2 * t / duration - 1
+    if sweep == 'hs':
+        # Hyperbolic secant: sech amplitude, tanh frequency sweep
+        env = 1 / np.cosh(beta * tau)
+        df = _col(bandwidth) / 2 * np.tanh(beta * tau)
+    elif sweep == 'linear':
+        env = np.ones_like(tau)
+        df = _col(bandwidth) / 2 * tau
+    else:
+        raise ValueError("Unknown sweep {:s}; use 'hs' or 'linear'".format(sweep))
+    phase = 2 * np.pi * np.cumsum(df * dt, axis=-1)
+    return _modulate(_col(amp) * env, t, freq, phase)
+
+def phase_modulated(duration, bandwidth, sweep='hs', beta=5.3, dt=0.1, amp=1, freq=0):
+    """ Frequency-swept (adiabatic) RF pulse.
+
+    bandwidth: total frequency sweep, MHz (batchable)
+    sweep: 'hs' for a hyperbolic secant pulse, 'linear' for a constant-amplitude chirp
+    beta: HS truncation factor (dimensionless); the amplitude falls to sech(beta) at the pulse edges
+    Other arguments as for sinc().
+    """
+    return _phase_modulated(float(duration), _hashable(bandwidth), float(beta), float(dt), _hashable(amp),
+                            _hashable(freq), sweep)
+
+@lru_cache(maxsize=cache_size)
+def _trapezoid(flat, ramp, dt, amp):
+    n_ramp = int(round(ramp / dt))
+    n_flat = int(round(flat / dt))
+    # Ramp samples exclude both 0 and full amplitude, so that trapezoids can be abutted
+    up = np.arange(1, n_ramp + 1) / (n_ramp + 1)
+    shape = np.concatenate([up, np.ones(n_flat), up[::-1]])
+    return _frozen((_col(amp) * shape).astype(np.float32))
+
+def trapezoid(flat, ramp, dt=sc.grad_t, amp=1):
+    """ Trapezoidal gradient lobe.
+
+    flat: flat-top duration, us
+    ramp: duration of each ramp, us
+    dt: sample period, us (the gradient update period by default)
+    amp: flat-top amplitude, full-scale units (batchable, e.g. for phase-encode tables)
+    """
+    return _trapezoid(float(flat), float(ramp), float(dt), _hashable(amp))
+
+@lru_cache(maxsize=cache_size)
+def _ramp(duration, start, stop, dt):
+    n = int(round(duration / dt))
+    frac = np.linspace(0, 1, n)
+    return _frozen((_col(start) + (_col(stop) - _col(start)) * frac).astype(np.float32))
+
+def ramp(duration, start, stop, dt=sc.grad_t):
+    """ Linear gradient ramp from start to stop (inclusive), full-scale units (both batchable) """
+    return _ramp(float(duration), _hashable(start), _hashable(stop), float(dt))
+
+_cached = (_sinc, _gaussian, _hard, _phase_modulated, _trapezoid, _ramp)
+
+def cache_info():
+    """ {waveform: functools cache statistics} """
+    return {f.__name__[1:]: f.cache_info() for f in _cached}
+
+def cache_clear():
+    for f in _cached:
+        f.cache_clear()
+
+def test_waveforms():
+    import time
+    tx_t = 0.1
+
+    # Phase-encode table: 64 gradient lobes in one call
+    pe = trapezoid(200, 30, amp=np.linspace(-1, 1, 64))
+    print("phase-encode table:", pe.shape, pe.dtype, "writeable:", pe.flags.writeable)
+
+    t0 = time.perf_counter()
+    for k in range(1000):
+        exc = sinc(200, lobes=4, dt=tx_t, amp=0.5)
+        inv = phase_modulated(1000, 0.02, dt=tx_t)
+        gx = trapezoid(500, 20, amp=(k % 64) / 64)
+    print("1000 sweep iterations: {:.1f} ms".format((time.perf_counter() - t0) * 1e3))
+    print(cache_info())
+
+if __name__ == "__main__":
+    test_waveforms()